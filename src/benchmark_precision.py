@@ -0,0 +1,110 @@
+import argparse
+import copy
+import time
+import torch
+from config import cfg
+from models.vqvae import VQVAE
+from models.utils import spectral_derivative_3d
+from metrics.metrics import MSE, D_MSE, Physics
+from utils import make_autocast
+
+parser = argparse.ArgumentParser(description='cfg')
+parser.add_argument('--device', default='cpu', type=str)
+parser.add_argument('--precision', default='bfloat16', type=str)
+parser.add_argument('--batch_size', default=1, type=int)
+parser.add_argument('--size', default=32, type=int)
+parser.add_argument('--depth', default=1, type=int)
+parser.add_argument('--num_repeats', default=3, type=int)
+parser.add_argument('--tolerance', default=0.02, type=float)
+args = vars(parser.parse_args())
+cfg['device'] = args['device']
+
+
+def make_input():
+    # smooth periodic field from the lowest Fourier modes, derivatives are taken spectrally as for the DNS data
+    generator = torch.Generator().manual_seed(0)
+    size = args['size']
+    spectrum = torch.zeros(args['batch_size'], 3, size, size, size // 2 + 1, dtype=torch.complex64)
+    spectrum[..., :4, :4, :4] = torch.randn(args['batch_size'], 3, 4, 4, 4, 2, generator=generator) \
+        .mul(size ** 3 / 8).view(torch.complex64).squeeze(-1)
+    uvw = torch.fft.irfftn(spectrum, s=(size, size, size), dim=(2, 3, 4)).to(args['device'])
+    return {'uvw': uvw, 'duvw': spectral_derivative_3d(uvw)}
+
+
+def make_model():
+    torch.manual_seed(0)
+    model = VQVAE(depth=args['depth'], d_mode=['exact', 'physics'], d_commit=[0.1, 1e-4])
+    return model.to(args['device'])
+
+
+def activation_memory(model, input, precision):
+    # bytes of the tensors autograd keeps for backward, the bulk of training memory
+    saved = {}
+
+    def pack(x):
+        saved[(x.data_ptr(), x.dtype)] = x.numel() * x.element_size()
+        return x
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda x: x):
+        with make_autocast(precision):
+            model(input, Epoch=26)
+    return sum(saved.values())
+
+
+def benchmark(model, input, precision):
+    model = copy.deepcopy(model).train(True)
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-3)
+    scaler = torch.cuda.amp.GradScaler(enabled=precision == 'float16')
+    memory = activation_memory(model, input, precision)
+    if input['uvw'].is_cuda:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    for i in range(args['num_repeats'] + 1):
+        if i == 1:
+            if input['uvw'].is_cuda:
+                torch.cuda.synchronize()
+            start_time = time.time()
+        optimizer.zero_grad()
+        with make_autocast(precision):
+            output = model(input, Epoch=26)
+        scaler.scale(output['loss']).backward()
+        scaler.step(optimizer)
+        scaler.update()
+    if input['uvw'].is_cuda:
+        torch.cuda.synchronize()
+        memory = torch.cuda.max_memory_allocated()
+    return (time.time() - start_time) / args['num_repeats'], memory
+
+
+def evaluate(model, input, precision):
+    with torch.no_grad(), make_autocast(precision):
+        output = model.train(False)(input)
+    return {'MSE': MSE(output['uvw'], input['uvw']), 'D_MSE': D_MSE(output['duvw'], input['duvw']),
+            'Physics': Physics(output['duvw'], input['duvw'])}
+
+
+if __name__ == "__main__":
+    input = make_input()
+    model = make_model()
+    result = {}
+    for precision in ['float32', args['precision']]:
+        result[precision] = benchmark(model, input, precision)
+    time_, memory = result['float32']
+    time_amp, memory_amp = result[args['precision']]
+    print('train step: float32 {:.4f}s {:.1f}MB  {} {:.4f}s {:.1f}MB  speedup: {:.2f}x  memory: {:.2f}x'.format(
+        time_, memory / 2 ** 20, args['precision'], time_amp, memory_amp / 2 ** 20, time_ / time_amp,
+        memory / memory_amp))
+    # short float32 warm up so the metrics compare a model that reconstructs the field
+    model = copy.deepcopy(model).train(True)
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-3)
+    for _ in range(20):
+        optimizer.zero_grad()
+        model(input)['loss'].backward()
+        optimizer.step()
+    evaluation = evaluate(model, input, 'float32')
+    evaluation_amp = evaluate(model, input, args['precision'])
+    for k in evaluation:
+        error = abs(evaluation_amp[k] - evaluation[k]) / abs(evaluation[k])
+        print('{}: float32 {:.6e}  {} {:.6e}  relative diff: {:.2e}  {}'.format(
+            k, evaluation[k], args['precision'], evaluation_amp[k], error,
+            'ok' if error <= args['tolerance'] else 'exceeds tolerance {}'.format(args['tolerance'])))
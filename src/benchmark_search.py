@@ -0,0 +1,50 @@
+import argparse
+import time
+import torch
+from modules import Search, TreeSearch
+
+parser = argparse.ArgumentParser(description='cfg')
+parser.add_argument('--device', default='cpu', type=str)
+parser.add_argument('--num_vectors', default=32768, type=int)
+parser.add_argument('--embedding_size', default=64, type=int)
+parser.add_argument('--num_embedding', default='512-4096-16384-65536', type=str)
+parser.add_argument('--noise', default=0.5, type=float)
+parser.add_argument('--num_probe', default='4-8-16', type=str)
+parser.add_argument('--memory', default=256, type=int)
+parser.add_argument('--num_repeats', default=3, type=int)
+args = vars(parser.parse_args())
+
+
+def benchmark(searcher, input, embedding, embedding_norm):
+    searcher(input, embedding, embedding_norm)
+    if input.is_cuda:
+        torch.cuda.synchronize()
+    start_time = time.time()
+    for _ in range(args['num_repeats']):
+        embedding_ind = searcher(input, embedding, embedding_norm)
+    if input.is_cuda:
+        torch.cuda.synchronize()
+    return (time.time() - start_time) / args['num_repeats'], embedding_ind
+
+
+if __name__ == "__main__":
+    torch.manual_seed(0)
+    memory = args['memory'] * 2 ** 20
+    for num_embedding in [int(x) for x in args['num_embedding'].split('-')]:
+        embedding = torch.randn(args['embedding_size'], num_embedding, device=args['device'])
+        embedding_norm = embedding.pow(2).sum(0)
+        # vectors scattered around random codewords, as encoder outputs are after training
+        target = torch.randint(num_embedding, (args['num_vectors'],), device=args['device'])
+        input = embedding.t()[target] + args['noise'] * torch.randn(args['num_vectors'], args['embedding_size'],
+                                                                    device=args['device'])
+        with torch.no_grad():
+            exact_time, exact_ind = benchmark(Search(memory), input, embedding, embedding_norm)
+            exact_error = (input - embedding.t()[exact_ind]).pow(2).sum(1).mean().item()
+            print('num_embedding {}: exact {:.4f}s'.format(num_embedding, exact_time))
+            for num_probe in [int(x) for x in args['num_probe'].split('-')]:
+                time_, embedding_ind = benchmark(TreeSearch(memory, num_probe), input, embedding, embedding_norm)
+                error = (input - embedding.t()[embedding_ind]).pow(2).sum(1).mean().item()
+                print('  tree ({} probes): {:.4f}s  speedup: {:.2f}x  recall@1: {:.4f}  '
+                      'quantization error increase: {:.2f}%'.format(
+                    num_probe, time_, exact_time / time_, (embedding_ind == exact_ind).float().mean().item(),
+                    100 * (error / exact_error - 1)))
@@ -0,0 +1,48 @@
+import argparse
+import numpy as np
+import time
+import torch
+from models.utils import spectral_derivative_3d
+
+parser = argparse.ArgumentParser(description='cfg')
+parser.add_argument('--device', default='cpu', type=str)
+parser.add_argument('--batch_size', default=1, type=int)
+parser.add_argument('--size', default=128, type=int)
+parser.add_argument('--num_repeats', default=5, type=int)
+args = vars(parser.parse_args())
+
+
+def spectral_derivative_3d_full(V):
+    # previous implementation: wavenumber grids rebuilt per call, full complex spectrum, one inverse per direction
+    N, C, H, W, D = V.size()
+    h = np.fft.fftfreq(H, 1. / H)
+    w = np.fft.fftfreq(W, 1. / W)
+    d = np.fft.fftfreq(D, 1. / D)
+    mesh_h, mesh_w, mesh_d = torch.tensor(np.meshgrid(h, w, d, indexing='ij'), device=V.device, dtype=V.dtype)
+    V_fft_hat = torch.fft.fftn(V, dim=(2, 3, 4)) * 1j
+    dV_dh = torch.fft.ifftn(V_fft_hat * mesh_h, dim=(2, 3, 4)).real
+    dV_dw = torch.fft.ifftn(V_fft_hat * mesh_w, dim=(2, 3, 4)).real
+    dV_dd = torch.fft.ifftn(V_fft_hat * mesh_d, dim=(2, 3, 4)).real
+    dV = torch.stack([dV_dh, dV_dw, dV_dd], dim=2)
+    return dV
+
+
+def benchmark(fn, V):
+    fn(V)
+    if V.is_cuda:
+        torch.cuda.synchronize()
+    start_time = time.time()
+    for _ in range(args['num_repeats']):
+        dV = fn(V)
+    if V.is_cuda:
+        torch.cuda.synchronize()
+    return (time.time() - start_time) / args['num_repeats'], dV
+
+
+if __name__ == "__main__":
+    V = torch.randn(args['batch_size'], 3, args['size'], args['size'], args['size'], device=args['device'])
+    with torch.no_grad():
+        full_time, full_dV = benchmark(spectral_derivative_3d_full, V)
+        time_, dV = benchmark(spectral_derivative_3d, V)
+    print('full spectrum: {:.4f}s  half spectrum (cached): {:.4f}s  speedup: {:.2f}x  max abs diff: {:.2e}'.format(
+        full_time, time_, full_time / time_, (full_dV - dV).abs().max().item()))
@@ -0,0 +1,58 @@
+import argparse
+import time
+import torch
+import torch.nn.functional as F
+
+parser = argparse.ArgumentParser(description='cfg')
+parser.add_argument('--device', default='cpu', type=str)
+parser.add_argument('--size', default=128, type=int)
+parser.add_argument('--embedding_size', default=64, type=int)
+parser.add_argument('--num_embedding', default=512, type=int)
+parser.add_argument('--num_repeats', default=5, type=int)
+args = vars(parser.parse_args())
+
+
+def ema_statistics_onehot(flatten, embedding_ind, num_embedding):
+    # previous implementation: dense one-hot assignment matrix
+    embedding_onehot = F.one_hot(embedding_ind, num_embedding).type(flatten.dtype)
+    return embedding_onehot.sum(0), flatten.transpose(0, 1) @ embedding_onehot
+
+
+def ema_statistics(flatten, embedding_ind, num_embedding):
+    embedding_count = torch.bincount(embedding_ind, minlength=num_embedding).type(flatten.dtype)
+    embedding_sum = flatten.new_zeros(num_embedding, flatten.size(1)).index_add_(0, embedding_ind, flatten)
+    return embedding_count, embedding_sum.t()
+
+
+def benchmark(fn, flatten, embedding_ind):
+    fn(flatten, embedding_ind, args['num_embedding'])
+    if flatten.is_cuda:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    base_memory = torch.cuda.memory_allocated() if flatten.is_cuda else 0
+    start_time = time.time()
+    for _ in range(args['num_repeats']):
+        output = fn(flatten, embedding_ind, args['num_embedding'])
+    if flatten.is_cuda:
+        torch.cuda.synchronize()
+    time_ = (time.time() - start_time) / args['num_repeats']
+    memory = torch.cuda.max_memory_allocated() - base_memory if flatten.is_cuda else None
+    return time_, memory, output
+
+
+if __name__ == "__main__":
+    for depth in [1, 2, 3]:
+        num_vectors = (args['size'] // 2 ** depth) ** 3
+        flatten = torch.randn(num_vectors, args['embedding_size'], device=args['device'])
+        embedding_ind = torch.randint(args['num_embedding'], (num_vectors,), device=args['device'])
+        onehot_time, onehot_memory, onehot_output = benchmark(ema_statistics_onehot, flatten, embedding_ind)
+        time_, memory, output = benchmark(ema_statistics, flatten, embedding_ind)
+        if onehot_memory is None:
+            # on CPU report the size of the temporaries each update allocates
+            element_size = flatten.element_size()
+            onehot_memory = (num_vectors + args['embedding_size'] + 1) * args['num_embedding'] * element_size
+            memory = (args['embedding_size'] + 1) * args['num_embedding'] * element_size
+        print('depth {} ({} vectors): one-hot {:.4f}s {:.1f}MB  scatter {:.4f}s {:.2f}MB  speedup: {:.2f}x  '
+              'max abs diff: {:.2e}'.format(depth, num_vectors, onehot_time, onehot_memory / 2 ** 20, time_,
+                                            memory / 2 ** 20, onehot_time / time_,
+                                            max((a - b).abs().max().item() for a, b in zip(onehot_output, output))))
@@ -0,0 +1,107 @@
+import json
+import numpy as np
+import os
+import struct
+import torch
+from entropy import compress, decompress
+from utils import makedir_exist_ok
+
+
+def make_correction(error, error_bound):
+    # corrections are multiples of step < 2 * error_bound, the margin absorbs float32 rounding when applied
+    step = 2 * error_bound * (1 - 1e-3)
+    value = np.rint(error.reshape(-1) / step).astype(np.int64)
+    position = np.flatnonzero(value)
+    return position, value[position], step
+
+
+def to_varint(input):
+    input = input.astype(np.uint64)
+    num_bits = np.floor(np.log2(np.maximum(input, 1))).astype(np.int64) + 1
+    num_bytes = (num_bits + 6) // 7
+    shift = np.arange(num_bytes.max(initial=1), dtype=np.uint64) * np.uint64(7)
+    output = ((input[:, None] >> shift) & np.uint64(0x7f)).astype(np.uint8)
+    more = np.arange(len(shift))[None, :] < (num_bytes[:, None] - 1)
+    output[more] |= 0x80
+    return output[np.arange(len(shift))[None, :] < num_bytes[:, None]]
+
+
+def from_varint(input):
+    if len(input) == 0:
+        return np.zeros(0, dtype=np.int64)
+    end = input < 0x80
+    group = np.concatenate([[0], np.cumsum(end)[:-1]]).astype(np.int64)
+    start = np.flatnonzero(np.concatenate([[True], end[:-1]]))
+    shift = ((np.arange(len(input)) - start[group]) * 7).astype(np.uint64)
+    output = np.zeros(int(end.sum()), dtype=np.uint64)
+    np.add.at(output, group, (input & 0x7f).astype(np.uint64) << shift)
+    return output.astype(np.int64)
+
+
+def compress_symbol(symbol, num_symbol):
+    if len(symbol) == 0:
+        return {'num_embedding': num_symbol, 'shape': [0]}, np.zeros(0, dtype=np.int64), []
+    # short side streams use fewer lanes, each lane costs a 64-bit final state
+    num_lanes = min(max(1, len(symbol) // 256), 4096)
+    return compress(symbol, {'num_embedding': num_symbol, 'shape': [len(symbol)]}, num_lanes)
+
+
+def save_correction(position, value, step, path, header):
+    # positions are gap coded as varint bytes, values zigzag coded, both streams are rANS coded
+    makedir_exist_ok(os.path.dirname(path))
+    gap = to_varint(np.diff(position, prepend=0))
+    zigzag = (value << 1) ^ (value >> 63)
+    symbol = {'position': (gap, 256), 'value': (zigzag, int(zigzag.max(initial=0)) + 1)}
+    header = {**header, 'step': step, 'num_correction': len(position)}
+    freq, stream = {}, {}
+    for k in symbol:
+        header[k], freq[k], stream[k] = compress_symbol(*symbol[k])
+    header_ = json.dumps(header).encode('utf-8')
+    with open(path, 'wb') as f:
+        f.write(b'VQB1')
+        f.write(struct.pack('<I', len(header_)))
+        f.write(header_)
+        for k in symbol:
+            f.write(freq[k].astype(np.uint32).tobytes())
+            f.write(np.array([len(s) for s in stream[k]], dtype=np.uint32).tobytes())
+            for s in stream[k]:
+                f.write(s.tobytes())
+    return
+
+
+class Correction(object):
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            if f.read(4) != b'VQB1':
+                raise ValueError('Not valid correction file')
+            header_size = struct.unpack('<I', f.read(4))[0]
+            self.header = json.loads(f.read(header_size).decode('utf-8'))
+            symbol = {}
+            for k in ['position', 'value']:
+                header = self.header[k]
+                if header['shape'][0] == 0:
+                    symbol[k] = np.zeros(0, dtype=np.int64)
+                    continue
+                freq = np.frombuffer(f.read(4 * header['num_embedding']), dtype=np.uint32).astype(np.int64)
+                stream_size = np.frombuffer(f.read(4 * header['num_lanes']), dtype=np.uint32)
+                stream = [np.frombuffer(f.read(4 * int(n)), dtype=np.uint32) for n in stream_size]
+                symbol[k] = decompress(header, freq, stream)
+        self.position = np.cumsum(from_varint(symbol['position'].astype(np.uint8)))
+        self.value = (symbol['value'] >> 1) ^ -(symbol['value'] & 1)
+        self.size = int(np.prod(self.header['shape'][1:]))
+
+    def __len__(self):
+        return self.header['shape'][0]
+
+    def __getitem__(self, index):
+        start, end = np.searchsorted(self.position, [index * self.size, (index + 1) * self.size])
+        return self.position[start:end] - index * self.size, self.value[start:end] * self.header['step']
+
+    def correct(self, decoded, index):
+        # decoded holds snapshot index with the layout used when the corrections were made
+        position, correction = self[index]
+        position = torch.from_numpy(position).to(decoded.device)
+        correction = torch.from_numpy(correction).to(decoded.device, decoded.dtype)
+        decoded = decoded.clone()
+        decoded.view(-1)[position] += correction
+        return decoded
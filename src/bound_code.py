@@ -0,0 +1,94 @@
+import argparse
+import numpy as np
+import os
+import torch
+import torch.backends.cudnn as cudnn
+import models
+from config import cfg
+from bound import Correction, make_correction, save_correction
+from data import fetch_dataset
+from utils import load_code, to_code, process_control, process_dataset, resume
+
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+cudnn.benchmark = True
+parser = argparse.ArgumentParser(description='cfg')
+for k in cfg:
+    exec('parser.add_argument(\'--{0}\', default=cfg[\'{0}\'], type=type(cfg[\'{0}\']))'.format(k))
+parser.add_argument('--control_name', default=None, type=str)
+parser.add_argument('--error_bound', default=1e-2, type=float)
+args = vars(parser.parse_args())
+for k in cfg:
+    cfg[k] = args[k]
+if args['control_name']:
+    cfg['control'] = {k: v for k, v in zip(cfg['control'].keys(), args['control_name'].split('_'))} \
+        if args['control_name'] != 'None' else {}
+cfg['control_name'] = '_'.join([cfg['control'][k] for k in cfg['control']])
+
+
+def main():
+    process_control()
+    seeds = list(range(cfg['init_seed'], cfg['init_seed'] + cfg['num_experiments']))
+    for i in range(cfg['num_experiments']):
+        model_tag_list = [str(seeds[i]), cfg['data_name'], cfg['subset'], cfg['model_name'], cfg['control_name']]
+        cfg['model_tag'] = '_'.join([x for x in model_tag_list if x])
+        print('Experiment: {}'.format(cfg['model_tag']))
+        runExperiment()
+    return
+
+
+def runExperiment():
+    seed = int(cfg['model_tag'].split('_')[0])
+    torch.manual_seed(seed)
+    torch.cuda.manual_seed(seed)
+    dataset = fetch_dataset(cfg['data_name'], cfg['subset'], ['uvw'])
+    process_dataset(dataset['train'])
+    model = eval('models.{}().to(cfg["device"])'.format(cfg['model_name']))
+    load_tag = 'best'
+    last_epoch, model, _, _, _ = resume(model, cfg['model_tag'], load_tag=load_tag)
+    model.fuse_normalization()
+    for split in dataset:
+        code_path = './output/code/{}_{}.{}'.format(split, cfg['model_tag'], cfg['code_format'])
+        bound(dataset[split], model, code_path, './output/code/{}_{}.vqb'.format(split, cfg['model_tag']))
+    return
+
+
+def decode(model, code):
+    # the corrections are only valid for the decoding they were made against, tiled decoding is periodic
+    if cfg['tile_memory'] > 0:
+        return model.decode_code_tiled(code, cfg['tile_memory'] * 2 ** 20)
+    return model.decode_code(code)
+
+
+def bound(dataset, model, code_path, path):
+    code, _ = load_code(code_path)
+    position, value = [], []
+    with torch.no_grad():
+        model.train(False)
+        for i in range(len(dataset)):
+            input = dataset[i]['uvw'].unsqueeze(0).to(cfg['device'])
+            decoded = decode(model, to_code(code[i:i + 1]).to(cfg['device']))
+            position_i, value_i, step = make_correction((input - decoded).cpu().numpy(), args['error_bound'])
+            position.append(position_i + i * input.numel())
+            value.append(value_i)
+        header = {'error_bound': args['error_bound'], 'shape': [len(dataset), *input.size()[1:]],
+                  'tiled': cfg['tile_memory'] > 0, 'model_tag': cfg['model_tag']}
+        save_correction(np.concatenate(position), np.concatenate(value), step, path, header)
+        correction = Correction(path)
+        max_error = 0
+        for i in range(len(dataset)):
+            input = dataset[i]['uvw'].unsqueeze(0).to(cfg['device'])
+            decoded = correction.correct(decode(model, to_code(code[i:i + 1]).to(cfg['device'])), i)
+            max_error = max(max_error, (input - decoded).abs().max().item())
+    if max_error > args['error_bound']:
+        raise ValueError('Not valid error bound')
+    num_value = len(dataset) * input.numel()
+    code_bits, correction_bits = os.path.getsize(code_path) * 8, os.path.getsize(path) * 8
+    print('{}: error bound {:.2e}, max error {:.2e}, {:.4f}% of values corrected'.format(
+        path, args['error_bound'], max_error, 100 * correction.header['num_correction'] / num_value))
+    print('code {:.4f} + correction {:.4f} bits per value, compression ratio {:.1f} against float32'.format(
+        code_bits / num_value, correction_bits / num_value, num_value * 32 / (code_bits + correction_bits)))
+    return
+
+
+if __name__ == "__main__":
+    main()
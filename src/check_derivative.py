@@ -0,0 +1,35 @@
+import argparse
+import torch
+from config import cfg
+from data import fetch_dataset, make_data_loader
+from models.utils import spectral_derivative_3d
+from utils import collate, to_device, process_control, process_dataset
+
+parser = argparse.ArgumentParser(description='cfg')
+parser.add_argument('--device', default='cpu', type=str)
+parser.add_argument('--tolerance', default=1e-3, type=float)
+args = vars(parser.parse_args())
+
+if __name__ == "__main__":
+    process_control()
+    cfg['device'] = args['device']
+    cfg['d_source'] = 'dns'
+    cfg['batch_size'] = {'train': 1, 'test': 1}
+    dataset = fetch_dataset(cfg['data_name'], cfg['subset'], ['uvw', 'duvw'])
+    process_dataset(dataset['train'])
+    data_loader = make_data_loader(dataset)
+    valid = True
+    for split in data_loader:
+        error, norm = torch.zeros(3, 3), torch.zeros(3, 3)
+        for i, input in enumerate(data_loader[split]):
+            input = collate(input)
+            input = to_device(input, cfg['device'])
+            with torch.no_grad():
+                duvw = spectral_derivative_3d(input['uvw'])
+            error += (duvw - input['duvw']).pow(2).sum(dim=[0, 3, 4, 5]).cpu()
+            norm += input['duvw'].pow(2).sum(dim=[0, 3, 4, 5]).cpu()
+        relative_error = (error / norm).sqrt()
+        print(split, 'relative L2 error per component:\n{}'.format(relative_error))
+        valid = valid and relative_error.max().item() < args['tolerance']
+    print('spectral derivative {} against DNS (tolerance: {})'.format('matches' if valid else 'does not match',
+                                                                      args['tolerance']))
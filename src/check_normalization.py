@@ -0,0 +1,51 @@
+import argparse
+import copy
+import torch
+from models.vqvae import VQVAE
+from models.utils import periodic_crop
+
+parser = argparse.ArgumentParser(description='cfg')
+parser.add_argument('--device', default='cpu', type=str)
+parser.add_argument('--size', default=32, type=int)
+parser.add_argument('--depth', default=2, type=int)
+parser.add_argument('--tolerance', default=1e-5, type=float)
+args = vars(parser.parse_args())
+
+if __name__ == "__main__":
+    torch.manual_seed(0)
+    # statistics far from zero mean and unit std, so a wrong fold shows up at the zero padded boundary
+    stats = ([1.5, -2., 0.5], [0.5, 2., 3.])
+    model = VQVAE(depth=args['depth'], num_embedding=64, stats=stats).to(args['device']).train(False)
+    # a non-periodic field, a crop of a larger random field with an offset
+    size = args['size']
+    input = periodic_crop(torch.randn(2, 3, 2 * size, 2 * size, 2 * size, device=args['device']) * 2 + 1,
+                          [3, 5, 7], [size, size, size], [2, 3, 4])
+    with torch.no_grad():
+        # codewords drawn from the encoder outputs, boundary codes then change with any change of the encoding
+        encoded = model.encoder(model.normalization(input)).transpose(1, -1)
+        encoded = encoded.reshape(-1, model.quantizer.embedding_size)
+        index = torch.randperm(encoded.size(0), device=encoded.device)[:model.quantizer.num_embedding]
+        model.quantizer.embedding.copy_(encoded[index].t())
+        model.quantizer.update_embedding_norm()
+    fused_model = copy.deepcopy(model)
+    fused_model.fuse_normalization()
+    with torch.no_grad():
+        # reference: the training forward path
+        _, _, code = model.encode(model.normalization(input))
+        quantized = model.quantizer.embedding_code(code).transpose(1, -1)
+        decoded = model.normalization.denormalize(model.decode(quantized))
+        code_unfused = model.encode_code(input)
+        code_fused = fused_model.encode_code(input)
+        decoded_unfused = model.decode_code(code)
+        decoded_fused = fused_model.decode_code(code)
+    valid = True
+    for name, x in [('unfused codes', code_unfused), ('fused codes', code_fused)]:
+        mismatch = (x != code).float().mean().item()
+        print('{}: mismatch against training forward {:.2e}'.format(name, mismatch))
+        valid = valid and mismatch == 0
+    for name, x in [('unfused decoding', decoded_unfused), ('fused decoding', decoded_fused)]:
+        error = ((x - decoded).abs().max() / decoded.abs().max()).item()
+        print('{}: max relative error against training forward {:.2e}'.format(name, error))
+        valid = valid and error < args['tolerance']
+    print('normalization fusion {} the unfused model (tolerance: {})'.format('matches' if valid else 'does not match',
+                                                                             args['tolerance']))
@@ -0,0 +1,90 @@
+import argparse
+import numpy as np
+import os
+import torch
+import models
+from config import cfg
+from utils import check_exists, load, save, save_code, load_code, make_code_dtype, process_control
+
+parser = argparse.ArgumentParser(description='cfg')
+for k in cfg:
+    exec('parser.add_argument(\'--{0}\', default=cfg[\'{0}\'], type=type(cfg[\'{0}\']))'.format(k))
+parser.add_argument('--control_name', default=None, type=str)
+args = vars(parser.parse_args())
+for k in cfg:
+    cfg[k] = args[k]
+if args['control_name']:
+    cfg['control'] = {k: v for k, v in zip(cfg['control'].keys(), args['control_name'].split('_'))} \
+        if args['control_name'] != 'None' else {}
+cfg['control_name'] = '_'.join([cfg['control'][k] for k in cfg['control']])
+
+
+def main():
+    process_control()
+    seeds = list(range(cfg['init_seed'], cfg['init_seed'] + cfg['num_experiments']))
+    for i in range(cfg['num_experiments']):
+        model_tag_list = [str(seeds[i]), cfg['data_name'], cfg['subset'], cfg['model_name'], cfg['control_name']]
+        cfg['model_tag'] = '_'.join([x for x in model_tag_list if x])
+        print('Experiment: {}'.format(cfg['model_tag']))
+        runExperiment()
+    return
+
+
+def runExperiment():
+    checkpoint = load('./output/model/{}_best.pt'.format(cfg['model_tag']))
+    model = eval('models.{}()'.format(cfg['model_name']))
+    model.load_state_dict(checkpoint['model_dict'])
+    code = {}
+    for split in ['train', 'test']:
+        path = './output/code/{}_{}.vqc'.format(split, cfg['model_tag'])
+        if check_exists(path):
+            code[split] = load_code(path)
+    if len(code) == 0:
+        raise ValueError('Not valid code, run encode.py first')
+    num_embedding = cfg['vqvae']['num_embedding']
+    quantizers = model.make_quantizers()
+    count = np.zeros((len(quantizers), num_embedding), dtype=np.int64)
+    for split in code:
+        code_split = code[split][0]
+        for i in range(code_split.shape[0]):
+            code_i = np.asarray(code_split[i]).reshape(len(quantizers), -1)
+            for j in range(len(quantizers)):
+                count[j] += np.bincount(code_i[j], minlength=num_embedding)
+    # every stage keeps its used codes first, stages share one compacted size
+    num_used = (count > 0).sum(axis=1)
+    compact_num_embedding = int(num_used.max())
+    remap = np.zeros((len(quantizers), num_embedding), dtype=np.int64)
+    for j in range(len(quantizers)):
+        order = np.argsort(count[j] == 0, kind='stable')[:compact_num_embedding]
+        remap[j, order] = np.arange(compact_num_embedding)
+        order = torch.from_numpy(order)
+        quantizer = quantizers[j]
+        quantizer.num_embedding = compact_num_embedding
+        quantizer.embedding = quantizer.embedding[:, order].contiguous()
+        quantizer.embedding_mean = quantizer.embedding_mean[:, order].contiguous()
+        quantizer.cluster_size = quantizer.cluster_size[order].contiguous()
+        quantizer.embedding_norm = quantizer.embedding_norm[order].contiguous()
+        quantizer.searcher.reset()
+        print('stage {}: {}/{} codes used'.format(j, num_used[j], num_embedding))
+    checkpoint['model_dict'] = model.state_dict()
+    checkpoint['config'] = {**checkpoint['config'], 'num_embedding': compact_num_embedding}
+    save(checkpoint, './output/model/{}_compact.pt'.format(cfg['model_tag']))
+    for split in code:
+        code_split, header = code[split]
+        path = './output/code/{}_{}_compact.vqc'.format(split, cfg['model_tag'])
+        header = {k: header[k] for k in ['depth', 'num_stage', 'model_tag'] if k in header}
+        header['num_embedding'] = compact_num_embedding
+        compact_code = np.empty(code_split.shape, dtype=make_code_dtype(compact_num_embedding))
+        for i in range(code_split.shape[0]):
+            compact_code[i] = np.take_along_axis(remap, np.asarray(code_split[i]).reshape(len(quantizers), -1),
+                                                 axis=1).reshape(code_split.shape[1:])
+        save_code(compact_code, path, header)
+        print('{}: {} -> {} bytes'.format(path, os.path.getsize('./output/code/{}_{}.vqc'.format(
+            split, cfg['model_tag'])), os.path.getsize(path)))
+    print('./output/model/{}_compact.pt: build with --num_embedding {}'.format(cfg['model_tag'],
+                                                                              compact_num_embedding))
+    return
+
+
+if __name__ == "__main__":
+    main()
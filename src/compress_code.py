@@ -0,0 +1,66 @@
+import argparse
+import numpy as np
+import os
+from delta import save_delta
+from entropy import save_vqz, load_vqz
+from utils import load_code, save_code
+
+parser = argparse.ArgumentParser(description='cfg')
+parser.add_argument('--path', required=True, type=str)
+parser.add_argument('--mode', default='compress', type=str)
+parser.add_argument('--key_interval', default=10, type=int)
+parser.add_argument('--num_stage', default=1, type=int)
+args = vars(parser.parse_args())
+
+
+def report(code, header, path):
+    num_voxel = code.size // header.get('num_stage', 1) * (2 ** header['depth']) ** 3
+    num_bits = os.path.getsize(path) * 8
+    float_bits = num_voxel * 3 * 32
+    print('{}: {:.4f} bits per voxel, compression ratio {:.1f} against float32'.format(
+        path, num_bits / num_voxel, float_bits / num_bits))
+    return
+
+
+def main():
+    if args['mode'] == 'compress':
+        code, header = load_code(args['path'])
+        path = '{}.vqz'.format(os.path.splitext(args['path'])[0])
+        save_vqz(code, path, header)
+        decoded, _ = load_vqz(path)
+        if not np.array_equal(decoded, code):
+            raise ValueError('Not valid lossless decoding')
+        report(code, header, args['path'])
+        report(code, header, path)
+    elif args['mode'] == 'delta':
+        code, header = load_code(args['path'])
+        path = '{}.vqd'.format(os.path.splitext(args['path'])[0])
+        save_delta(code, path, header, args['key_interval'])
+        decoded, _ = load_code(path)
+        if not np.array_equal(decoded[:], code):
+            raise ValueError('Not valid lossless decoding')
+        report(code, header, args['path'])
+        report(code, header, path)
+        print('delta archive size reduction: {:.1f}%'.format(
+            100 * (1 - os.path.getsize(path) / os.path.getsize(args['path']))))
+    elif args['mode'] == 'truncate':
+        code, header = load_code(args['path'])
+        if header.get('num_stage', 1) <= args['num_stage']:
+            raise ValueError('Not valid number of stages')
+        code = code[:, :args['num_stage']]
+        header = {k: header[k] for k in ['num_embedding', 'depth', 'model_tag']}
+        header['num_stage'] = args['num_stage']
+        path = '{}_stage{}.vqc'.format(os.path.splitext(args['path'])[0], args['num_stage'])
+        save_code(code, path, header)
+        report(code, header, path)
+    elif args['mode'] == 'decompress':
+        code, header = load_vqz(args['path'])
+        header = {k: header[k] for k in ['num_embedding', 'depth', 'num_stage', 'model_tag'] if k in header}
+        save_code(code, '{}.vqc'.format(os.path.splitext(args['path'])[0]), header)
+    else:
+        raise ValueError('Not valid mode')
+    return
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,24 @@
 import torch
+import torch.distributed as dist
 import datasets
 from torch.utils.data import DataLoader
 from torch.utils.data.dataloader import default_collate
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Subset
+from torch.utils.data.distributed import DistributedSampler
 from config import cfg
+from models.utils import derivative_3d
+from utils import to_code
 
 
-def fetch_dataset(data_name, subset):
+def fetch_dataset(data_name, subset, fields=None):
     dataset = {}
     print('fetching data {}...'.format(data_name))
     root = './data/{}'.format(data_name)
     if data_name == 'Turb':
-        dataset['train'] = datasets.Turb(root=root, split='train', subset=subset)
-        dataset['test'] = datasets.Turb(root=root, split='test', subset=subset)
+        dataset['train'] = datasets.Turb(root=root, split='train', subset=subset, fields=fields,
+                                         d_source=cfg['d_source'])
+        dataset['test'] = datasets.Turb(root=root, split='test', subset=subset, fields=fields,
+                                        d_source=cfg['d_source'])
     else:
         raise ValueError('Not valid dataset name')
     print('data ready')
@@ -30,22 +36,52 @@ def input_collate(batch):
         return default_collate(batch)
 
 
+def make_fields():
+    fields = [cfg['subset']]
+    d_mode = cfg['d_mode'] if 'd_mode' in cfg else []
+    metric_names = [m for split in cfg['metric_name'] for m in cfg['metric_name'][split]]
+    if 'exact' in d_mode or 'physics' in d_mode or 'D_MSE' in metric_names or 'Physics' in metric_names:
+        fields.append('d{}'.format(cfg['subset']))
+    return fields
+
+
+def make_derivative(input, periodic=True):
+    if (cfg['d_source'] == 'spectral' or not periodic) and 'd{}'.format(cfg['subset']) in make_fields():
+        with torch.no_grad():
+            input['d{}'.format(cfg['subset'])] = derivative_3d(input[cfg['subset']], periodic)
+    return input
+
+
 def make_data_loader(dataset):
     data_loader = {}
     for k in dataset:
-        data_loader[k] = torch.utils.data.DataLoader(dataset=dataset[k], shuffle=cfg['shuffle'][k],
-                                                     batch_size=cfg['batch_size'][k], pin_memory=True,
-                                                     num_workers=cfg['num_workers'], collate_fn=input_collate)
+        if dist.is_initialized():
+            # each replica loads its own shard, shuffled per epoch through sampler.set_epoch
+            sampler = DistributedSampler(dataset[k], shuffle=cfg['shuffle'][k])
+            data_loader[k] = torch.utils.data.DataLoader(dataset=dataset[k], sampler=sampler,
+                                                         batch_size=cfg['batch_size'][k], pin_memory=True,
+                                                         num_workers=cfg['num_workers'], collate_fn=input_collate)
+        else:
+            data_loader[k] = torch.utils.data.DataLoader(dataset=dataset[k], shuffle=cfg['shuffle'][k],
+                                                         batch_size=cfg['batch_size'][k], pin_memory=True,
+                                                         num_workers=cfg['num_workers'], collate_fn=input_collate)
     return data_loader
 
 
+def make_shard(dataset):
+    # sequence windows are independent, each replica takes every world_size-th one
+    if dist.is_initialized():
+        dataset = Subset(dataset, list(DistributedSampler(dataset, shuffle=False)))
+    return dataset
+
+
 class BatchDataset(Dataset):
     def __init__(self, dataset, seq_length, seq_length_pre):
         super().__init__()
         self.dataset = dataset
         self.seq_length = seq_length
         self.seq_length_pre = seq_length_pre
-        self.S = dataset.size(1)
+        self.S = dataset.shape[1]
         self.idx = list(range(0, self.S - (seq_length + seq_length_pre), 1))
 
     def __len__(self):
@@ -53,6 +89,28 @@ class BatchDataset(Dataset):
 
     def __getitem__(self, index):
         seq_length = min(self.seq_length, self.S - 1 - index)
-        input = {'code': self.dataset[:, self.idx[index]:self.idx[index] + seq_length],
-                 'ncode': self.dataset[:, self.idx[index] + seq_length:self.idx[index] +  seq_length + self.seq_length_pre]}
-        return input
\ No newline at end of file
+        input = {'code': to_code(self.dataset[:, self.idx[index]:self.idx[index] + seq_length]),
+                 'ncode': to_code(self.dataset[:, self.idx[index] + seq_length:self.idx[index] + seq_length +
+                                                                               self.seq_length_pre])}
+        return input
+
+
+class CropDataset(Dataset):
+    def __init__(self, dataset, crop_size, num_crops):
+        super().__init__()
+        self.dataset = dataset
+        self.crop_size = crop_size
+        self.num_crops = num_crops
+
+    def __len__(self):
+        return len(self.dataset) * self.num_crops
+
+    def __getitem__(self, index):
+        input = self.dataset[index // self.num_crops]
+        uvw = input[cfg['subset']]
+        for i in range(1, uvw.dim()):
+            start = torch.randint(uvw.size(i), (1,)).item()
+            crop_idx = torch.arange(start, start + self.crop_size) % uvw.size(i)
+            uvw = uvw.index_select(i, crop_idx)
+        input = {cfg['subset']: uvw}
+        return input
@@ -1,4 +1,6 @@
+import multiprocessing
 import os
+import time
 import torch
 import h5py
 import numpy as np
@@ -9,25 +11,39 @@ from utils import check_exists, makedir_exist_ok, save, load
 class Turb(Dataset):
     data_name = 'Turb'
 
-    def __init__(self, root, split, subset):
+    def __init__(self, root, split, subset, fields=None, d_source='dns'):
         self.root = os.path.expanduser(root)
         self.split = split
         self.subset = subset
-        if not check_exists(self.processed_folder):
+        self.d_source = d_source
+        # the split indices are saved last and atomically, a partial ingest leaves them missing and is redone
+        if not all(check_exists(os.path.join(self.processed_folder, '{}.pt'.format(split)))
+                   for split in ['train', 'test']):
             self.process()
         self.input = load(os.path.join(self.processed_folder, '{}.pt'.format(self.split)))[self.subset]
+        self.fields = list(self.input.keys()) if fields is None else list(fields)
+        if self.d_source == 'spectral':
+            self.fields = [s for s in self.fields if s != 'd{}'.format(self.subset)]
+        elif self.d_source != 'dns':
+            raise ValueError('Not valid d_source')
+        self.input = {s: self.input[s] for s in self.fields}
+        for s in self.input:
+            if isinstance(self.input[s], str):
+                self.input[s] = np.load(os.path.join(self.processed_folder, self.input[s]), mmap_mode='c')
 
     def __getitem__(self, index):
         input = {}
         for s in self.input:
-            if isinstance(self.input[s][index], str):
+            if isinstance(self.input[s], np.memmap):
+                input[s] = torch.from_numpy(self.input[s][index])
+            elif isinstance(self.input[s][index], str):
                 input[s] = torch.tensor(load(self.input[s][index]))
             else:
                 input[s] = torch.tensor(self.input[s][index])
         return input
 
     def __len__(self):
-        return len(self.input['uvw'])
+        return len(self.input[self.subset])
 
     @property
     def processed_folder(self):
@@ -40,15 +56,15 @@ class Turb(Dataset):
     def process(self):
         if not check_exists(self.raw_folder):
             raise ValueError('Not valid dataset')
-        train_set, test_set = self.make_data()
         makedir_exist_ok(self.processed_folder)
+        train_set, test_set = self.make_data()
         save(train_set, os.path.join(self.processed_folder, 'train.pt'))
         save(test_set, os.path.join(self.processed_folder, 'test.pt'))
         return
 
     def __repr__(self):
-        fmt_str = 'Dataset {}\nSize: {}\nRoot: {}\nSplit: {}\nSubset: {}'.format(
-            self.__class__.__name__, self.__len__(), self.root, self.split, self.subset)
+        fmt_str = 'Dataset {}\nSize: {}\nRoot: {}\nSplit: {}\nSubset: {}\nFields: {}\nDerivative: {}'.format(
+            self.__class__.__name__, self.__len__(), self.root, self.split, self.subset, self.fields, self.d_source)
         return fmt_str
 
     def make_data(self):
@@ -57,64 +73,49 @@ class Turb(Dataset):
         Ng, Nb = 128, 16
         train_ts = np.arange(4050, 7050, 75).astype(np.int64)
         test_ts = np.arange(7050, 10050, 75).astype(np.int64)
-        train_uvw = []
-        train_duvw = []
-        for i in range(len(train_ts)):
-            u, v, w = np.zeros((Ng, Ng, Ng)), np.zeros((Ng, Ng, Ng)), np.zeros((Ng, Ng, Ng))
-            du, dv, dw = np.zeros((3, Ng, Ng, Ng)), np.zeros((3, Ng, Ng, Ng)), np.zeros((3, Ng, Ng, Ng))
-            for b in range(0, Nb):
-                f = h5py.File(os.path.join(self.raw_folder, sub_folder, '{}.{:06.0f}.h5.{:06.0f}'.format(
-                    filename_lead, train_ts[i], b)), 'r')
-                i_min, i_max = b // 4 * Ng // 4, (b // 4 + 1) * Ng // 4
-                j_min, j_max = (b % 4) * Ng // 4, ((b % 4) + 1) * Ng // 4
-                u[i_min:i_max, j_min:j_max, :] = f['Phy_W'][:]
-                v[i_min:i_max, j_min:j_max, :] = f['Phy_V'][:]
-                w[i_min:i_max, j_min:j_max, :] = f['Phy_U'][:]
-                du[0, i_min:i_max, j_min:j_max, :] = f['dWdzG'][:]
-                du[1, i_min:i_max, j_min:j_max, :] = f['dWdyG'][:]
-                du[2, i_min:i_max, j_min:j_max, :] = f['dWdxG'][:]
-                dv[0, i_min:i_max, j_min:j_max, :] = f['dVdzG'][:]
-                dv[1, i_min:i_max, j_min:j_max, :] = f['dVdyG'][:]
-                dv[2, i_min:i_max, j_min:j_max, :] = f['dVdxG'][:]
-                dw[0, i_min:i_max, j_min:j_max, :] = f['dUdzG'][:]
-                dw[1, i_min:i_max, j_min:j_max, :] = f['dUdyG'][:]
-                dw[2, i_min:i_max, j_min:j_max, :] = f['dUdxG'][:]
-                f.close()
-            uvw = np.stack([u, v, w], axis=0).astype(np.float32)
-            duvw = np.stack([du, dv, dw], axis=0).astype(np.float32)
-            save(uvw, os.path.join(self.raw_folder, '{}.pkl'.format(train_ts[i])))
-            save(duvw, os.path.join(self.raw_folder, '{}_d.pkl'.format(train_ts[i])))
-            train_uvw.append(os.path.join(self.raw_folder, '{}.pkl'.format(train_ts[i])))
-            train_duvw.append(os.path.join(self.raw_folder, '{}_d.pkl'.format(train_ts[i])))
-        test_uvw = []
-        test_duvw = []
-        for i in range(len(test_ts)):
-            u, v, w = np.zeros((Ng, Ng, Ng)), np.zeros((Ng, Ng, Ng)), np.zeros((Ng, Ng, Ng))
-            du, dv, dw = np.zeros((3, Ng, Ng, Ng)), np.zeros((3, Ng, Ng, Ng)), np.zeros((3, Ng, Ng, Ng))
-            for b in range(0, Nb):
-                f = h5py.File(os.path.join(self.raw_folder, sub_folder, '{}.{:06.0f}.h5.{:06.0f}'.format(
-                    filename_lead, test_ts[i], b)), 'r')
-                i_min, i_max = b // 4 * Ng // 4, (b // 4 + 1) * Ng // 4
-                j_min, j_max = (b % 4) * Ng // 4, ((b % 4) + 1) * Ng // 4
-                u[i_min:i_max, j_min:j_max, :] = f['Phy_W'][:]
-                v[i_min:i_max, j_min:j_max, :] = f['Phy_V'][:]
-                w[i_min:i_max, j_min:j_max, :] = f['Phy_U'][:]
-                du[0, i_min:i_max, j_min:j_max, :] = f['dWdzG'][:]
-                du[1, i_min:i_max, j_min:j_max, :] = f['dWdyG'][:]
-                du[2, i_min:i_max, j_min:j_max, :] = f['dWdxG'][:]
-                dv[0, i_min:i_max, j_min:j_max, :] = f['dVdzG'][:]
-                dv[1, i_min:i_max, j_min:j_max, :] = f['dVdyG'][:]
-                dv[2, i_min:i_max, j_min:j_max, :] = f['dVdxG'][:]
-                dw[0, i_min:i_max, j_min:j_max, :] = f['dUdzG'][:]
-                dw[1, i_min:i_max, j_min:j_max, :] = f['dUdyG'][:]
-                dw[2, i_min:i_max, j_min:j_max, :] = f['dUdxG'][:]
-                f.close()
-            uvw = np.stack([u, v, w], axis=0).astype(np.float32)
-            duvw = np.stack([du, dv, dw], axis=0).astype(np.float32)
-            save(uvw, os.path.join(self.raw_folder, '{}.pkl'.format(test_ts[i])))
-            save(duvw, os.path.join(self.raw_folder, '{}_d.pkl'.format(test_ts[i])))
-            test_uvw.append(os.path.join(self.raw_folder, '{}.pkl'.format(test_ts[i])))
-            test_duvw.append(os.path.join(self.raw_folder, '{}_d.pkl'.format(test_ts[i])))
+        raw_path = os.path.join(self.raw_folder, sub_folder, filename_lead)
+        train_uvw, train_duvw = make_snapshots(raw_path, self.processed_folder, 'train', train_ts, Ng, Nb)
+        test_uvw, test_duvw = make_snapshots(raw_path, self.processed_folder, 'test', test_ts, Ng, Nb)
         train_uvw_result = {'ts': train_ts, 'uvw': train_uvw, 'duvw': train_duvw}
         test_uvw_result = {'ts': test_ts, 'uvw': test_uvw, 'duvw': test_duvw}
-        return {'uvw': train_uvw_result}, {'uvw': test_uvw_result}
\ No newline at end of file
+        return {'uvw': train_uvw_result}, {'uvw': test_uvw_result}
+
+
+uvw_keys = ['Phy_W', 'Phy_V', 'Phy_U']
+duvw_keys = [['dWdzG', 'dWdyG', 'dWdxG'], ['dVdzG', 'dVdyG', 'dVdxG'], ['dUdzG', 'dUdyG', 'dUdxG']]
+
+
+def make_snapshot(args):
+    raw_path, processed_folder, uvw_filename, duvw_filename, i, ts, Ng, Nb = args
+    uvw = np.load(os.path.join(processed_folder, uvw_filename), mmap_mode='r+')
+    duvw = np.load(os.path.join(processed_folder, duvw_filename), mmap_mode='r+')
+    for b in range(0, Nb):
+        with h5py.File('{}.{:06.0f}.h5.{:06.0f}'.format(raw_path, ts, b), 'r') as f:
+            i_min, i_max = b // 4 * Ng // 4, (b // 4 + 1) * Ng // 4
+            j_min, j_max = (b % 4) * Ng // 4, ((b % 4) + 1) * Ng // 4
+            for c in range(3):
+                uvw[i, c, i_min:i_max, j_min:j_max, :] = f[uvw_keys[c]][:]
+                for d in range(3):
+                    duvw[i, c, d, i_min:i_max, j_min:j_max, :] = f[duvw_keys[c][d]][:]
+    uvw.flush()
+    duvw.flush()
+    return uvw[i].nbytes + duvw[i].nbytes
+
+
+def make_snapshots(raw_path, processed_folder, split, ts, Ng, Nb, num_workers=None):
+    num_workers = min(os.cpu_count() if num_workers is None else num_workers, len(ts))
+    uvw_filename, duvw_filename = '{}_uvw.npy'.format(split), '{}_duvw.npy'.format(split)
+    np.lib.format.open_memmap(os.path.join(processed_folder, uvw_filename), mode='w+', dtype=np.float32,
+                              shape=(len(ts), 3, Ng, Ng, Ng)).flush()
+    np.lib.format.open_memmap(os.path.join(processed_folder, duvw_filename), mode='w+', dtype=np.float32,
+                              shape=(len(ts), 3, 3, Ng, Ng, Ng)).flush()
+    args = [(raw_path, processed_folder, uvw_filename, duvw_filename, i, ts[i], Ng, Nb) for i in range(len(ts))]
+    start_time = time.time()
+    nbytes = 0
+    with multiprocessing.Pool(num_workers) as pool:
+        for i, nbytes_i in enumerate(pool.imap(make_snapshot, args)):
+            nbytes += nbytes_i
+            elapsed_time = time.time() - start_time
+            print('processed ts {} ({}/{})  {:.1f} MB/s'.format(ts[i], i + 1, len(ts),
+                                                              nbytes / 2 ** 20 / elapsed_time))
+    return uvw_filename, duvw_filename
@@ -0,0 +1,76 @@
+import json
+import numpy as np
+import os
+import struct
+from utils import makedir_exist_ok, make_code_dtype
+
+
+def save_delta(code, path, header, key_interval):
+    makedir_exist_ok(os.path.dirname(path))
+    code = np.ascontiguousarray(code, dtype=make_code_dtype(header['num_embedding']))
+    offset, num_delta, chunk = [], [], []
+    size = 0
+    for t in range(code.shape[0]):
+        if t % key_interval == 0:
+            data = [code[t].tobytes()]
+            num_delta.append(-1)
+        else:
+            position = np.flatnonzero(code[t] != code[t - 1]).astype(np.uint32)
+            data = [position.tobytes(), code[t].reshape(-1)[position].tobytes()]
+            num_delta.append(len(position))
+        offset.append(size)
+        size += sum(len(d) for d in data)
+        chunk.extend(data)
+    header = {**header, 'shape': list(code.shape), 'dtype': code.dtype.name, 'key_interval': key_interval,
+              'offset': offset, 'num_delta': num_delta}
+    header = json.dumps(header).encode('utf-8')
+    with open(path, 'wb') as f:
+        f.write(b'VQD1')
+        f.write(struct.pack('<I', len(header)))
+        f.write(header)
+        for d in chunk:
+            f.write(d)
+    return
+
+
+class DeltaCode(object):
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            if f.read(4) != b'VQD1':
+                raise ValueError('Not valid delta code file')
+            header_size = struct.unpack('<I', f.read(4))[0]
+            self.header = json.loads(f.read(header_size).decode('utf-8'))
+        self.data = np.memmap(path, dtype=np.uint8, mode='r', offset=8 + header_size)
+        self.shape = tuple(self.header['shape'])
+        self.dtype = np.dtype(self.header['dtype'])
+        self.t = None
+        self.code = None
+
+    def __len__(self):
+        return self.shape[0]
+
+    def read(self, t):
+        offset, num_delta = self.header['offset'][t], self.header['num_delta'][t]
+        if num_delta < 0:
+            size = int(np.prod(self.shape[1:])) * self.dtype.itemsize
+            self.code = np.frombuffer(self.data[offset:offset + size], dtype=self.dtype).reshape(self.shape[1:])
+            self.code = self.code.copy()
+        else:
+            position = np.frombuffer(self.data[offset:offset + 4 * num_delta], dtype=np.uint32)
+            offset = offset + 4 * num_delta
+            value = np.frombuffer(self.data[offset:offset + num_delta * self.dtype.itemsize], dtype=self.dtype)
+            self.code.reshape(-1)[position] = value
+        self.t = t
+        return
+
+    def seek(self, t):
+        key_t = t // self.header['key_interval'] * self.header['key_interval']
+        start = self.t + 1 if self.t is not None and key_t <= self.t <= t else key_t
+        for i in range(start, t + 1):
+            self.read(i)
+        return self.code.copy()
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return np.stack([self.seek(t) for t in range(*index.indices(len(self)))], axis=0)
+        return self.seek(index if index >= 0 else len(self) + index)
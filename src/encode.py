@@ -4,8 +4,10 @@ import torch
 import torch.backends.cudnn as cudnn
 import models
 from config import cfg
+from torch.utils.data import Subset
 from data import fetch_dataset, make_data_loader
-from utils import save, to_device, process_control, process_dataset, resume, collate, vis
+from utils import check_exists, makedir_exist_ok, make_code, load_code, to_device, process_control, process_dataset, resume, collate, \
+    make_autocast
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 cudnn.benchmark = True
@@ -38,30 +40,62 @@ def runExperiment():
     seed = int(cfg['model_tag'].split('_')[0])
     torch.manual_seed(seed)
     torch.cuda.manual_seed(seed)
-    dataset = fetch_dataset(cfg['data_name'], cfg['subset'])
+    dataset = fetch_dataset(cfg['data_name'], cfg['subset'], ['uvw'])
     process_dataset(dataset['train'])
-    data_loader = make_data_loader(dataset)
     model = eval('models.{}().to(cfg["device"])'.format(cfg['model_name']))
     load_tag = 'best'
     last_epoch, model, _, _, _ = resume(model, cfg['model_tag'], load_tag=load_tag)
-    train_code = encode(data_loader['train'], model)
-    test_code = encode(data_loader['test'], model)
-    save(train_code, './output/code/train_{}.pt'.format(cfg['model_tag']))
-    save(test_code, './output/code/test_{}.pt'.format(cfg['model_tag']))
+    model.fuse_normalization()
+    for split in dataset:
+        encode(dataset, split, model, './output/code/{}_{}.vqc'.format(split, cfg['model_tag']))
     return
 
 
-def encode(data_loader, model):
+def encode(dataset, split, model, path):
+    progress_path = '{}.progress'.format(path)
+    if check_exists(path) and not check_exists(progress_path):
+        print('Already encoded: {}'.format(path))
+        return
+    if check_exists(path) and check_exists(progress_path):
+        with open(progress_path, 'r') as f:
+            start = int(f.read())
+        print('Resume encoding {} from {}'.format(path, start))
+    else:
+        # the progress file is written before the store appears, a crash in between restarts from 0
+        header = {'num_embedding': cfg['vqvae']['num_embedding'], 'depth': cfg['depth'],
+                  'num_stage': cfg['vqvae']['num_stage'], 'model_tag': cfg['model_tag']}
+        shape = [len(dataset[split])] + ([cfg['vqvae']['num_stage']] if cfg['vqvae']['num_stage'] > 1 else []) + \
+                [cfg['data_shape'][i] // (2 ** cfg['depth']) for i in [3, 1, 2]]
+        start = 0
+        save_progress(start, progress_path)
+        make_code('{}.tmp'.format(path), header, shape)
+        os.replace('{}.tmp'.format(path), path)
+    code, _ = load_code(path, mode='r+')
+    data_loader = make_data_loader({split: Subset(dataset[split], range(start, len(dataset[split])))})[split]
     with torch.no_grad():
         model.train(False)
-        code = []
         for i, input in enumerate(data_loader):
             input = collate(input)
             input = to_device(input, cfg['device'])
-            _, _, code_i = model.encode(input['uvw'])
-            code.append(code_i)
-        code = torch.cat(code, dim=0)
-    return code
+            with make_autocast():
+                if cfg['tile_memory'] > 0:
+                    code_i = model.encode_tiled(input['uvw'], cfg['tile_memory'] * 2 ** 20)
+                else:
+                    code_i = model.encode_code(input['uvw'])
+            code[start:start + code_i.size(0)] = code_i.cpu().numpy()
+            code.flush()
+            start += code_i.size(0)
+            save_progress(start, progress_path)
+    os.remove(progress_path)
+    return
+
+
+def save_progress(start, path):
+    makedir_exist_ok(os.path.dirname(path))
+    with open('{}.tmp'.format(path), 'w') as f:
+        f.write(str(start))
+    os.replace('{}.tmp'.format(path), path)
+    return
 
 
 if __name__ == "__main__":
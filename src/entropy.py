@@ -0,0 +1,123 @@
+import json
+import math
+import numpy as np
+import os
+import struct
+from utils import makedir_exist_ok
+
+# 64-bit rANS with 32-bit renormalization, interleaved over independent lanes so every step is vectorized
+rans_l = np.uint64(1 << 31)
+word_mask = np.uint64((1 << 32) - 1)
+
+
+def make_freq(code, num_embedding, scale_bits):
+    count = np.bincount(np.asarray(code).reshape(-1), minlength=num_embedding).astype(np.int64)
+    used = count > 0
+    total = 1 << scale_bits
+    freq = np.zeros(num_embedding, dtype=np.int64)
+    freq[used] = count[used] * (total - used.sum()) // count.sum() + 1
+    freq[np.argmax(freq)] += total - freq.sum()
+    return freq
+
+
+def make_scale_bits(num_embedding):
+    return min(max(16, math.ceil(math.log2(num_embedding)) + 4), 24)
+
+
+def rans_encode(symbol, freq, scale_bits, num_lanes):
+    cum = np.concatenate([[0], np.cumsum(freq)[:-1]]).astype(np.uint64)
+    freq = freq.astype(np.uint64)
+    scale = np.uint64(scale_bits)
+    symbol = symbol.reshape(-1, num_lanes)
+    T = symbol.shape[0]
+    x = np.full(num_lanes, rans_l, dtype=np.uint64)
+    words = np.zeros((num_lanes, T + 2), dtype=np.uint32)
+    pos = np.zeros(num_lanes, dtype=np.int64)
+    lane = np.arange(num_lanes)
+    x_max_base = (rans_l >> scale) << np.uint64(32)
+    for t in range(T - 1, -1, -1):
+        s = symbol[t]
+        f = freq[s]
+        flush = x >= x_max_base * f
+        words[lane[flush], pos[flush]] = (x[flush] & word_mask).astype(np.uint32)
+        pos[flush] += 1
+        x[flush] >>= np.uint64(32)
+        x = ((x // f) << scale) + (x % f) + cum[s]
+    stream = []
+    for k in range(num_lanes):
+        stream.append(np.concatenate([[x[k] >> np.uint64(32), x[k] & word_mask],
+                                      words[k, :pos[k]][::-1]]).astype(np.uint32))
+    return stream
+
+
+def rans_decode(stream, freq, scale_bits, num_symbol, num_lanes):
+    cum = np.concatenate([[0], np.cumsum(freq)[:-1]]).astype(np.uint64)
+    cum2sym = np.repeat(np.arange(len(freq)), freq)
+    freq = freq.astype(np.uint64)
+    scale = np.uint64(scale_bits)
+    mask = np.uint64((1 << scale_bits) - 1)
+    T = num_symbol // num_lanes
+    words = np.zeros((num_lanes, max(len(s) for s in stream) + 1), dtype=np.uint64)
+    for k in range(num_lanes):
+        words[k, :len(stream[k])] = stream[k]
+    lane = np.arange(num_lanes)
+    x = (words[:, 0] << np.uint64(32)) | words[:, 1]
+    pos = np.full(num_lanes, 2, dtype=np.int64)
+    symbol = np.empty((T, num_lanes), dtype=np.int64)
+    for t in range(T):
+        slot = x & mask
+        s = cum2sym[slot]
+        symbol[t] = s
+        x = freq[s] * (x >> scale) + slot - cum[s]
+        refill = x < rans_l
+        x[refill] = (x[refill] << np.uint64(32)) | words[lane[refill], pos[refill]]
+        pos[refill] += 1
+    return symbol.reshape(-1)
+
+
+def compress(code, header, num_lanes=4096):
+    code = np.asarray(code).reshape(-1).astype(np.int64)
+    num_symbol = code.size
+    num_lanes = max(1, min(num_lanes, num_symbol))
+    pad = -num_symbol % num_lanes
+    scale_bits = make_scale_bits(header['num_embedding'])
+    freq = make_freq(code, header['num_embedding'], scale_bits)
+    symbol = np.concatenate([code, np.full(pad, np.argmax(freq), dtype=np.int64)])
+    stream = rans_encode(symbol, freq, scale_bits, num_lanes)
+    header = {**header, 'scale_bits': scale_bits, 'num_lanes': num_lanes, 'num_symbol': num_symbol}
+    return header, freq, stream
+
+
+def decompress(header, freq, stream):
+    num_symbol = header['num_symbol'] + (-header['num_symbol'] % header['num_lanes'])
+    symbol = rans_decode(stream, freq, header['scale_bits'], num_symbol, header['num_lanes'])
+    code = symbol[:header['num_symbol']].reshape(header['shape'])
+    return code
+
+
+def save_vqz(code, path, header):
+    makedir_exist_ok(os.path.dirname(path))
+    header, freq, stream = compress(code, header)
+    header = json.dumps(header).encode('utf-8')
+    with open(path, 'wb') as f:
+        f.write(b'VQZ1')
+        f.write(struct.pack('<I', len(header)))
+        f.write(header)
+        f.write(freq.astype(np.uint32).tobytes())
+        f.write(np.array([len(s) for s in stream], dtype=np.uint32).tobytes())
+        for s in stream:
+            f.write(s.tobytes())
+    return
+
+
+def load_vqz(path):
+    with open(path, 'rb') as f:
+        if f.read(4) != b'VQZ1':
+            raise ValueError('Not valid vqz file')
+        header_size = struct.unpack('<I', f.read(4))[0]
+        header = json.loads(f.read(header_size).decode('utf-8'))
+        freq = np.frombuffer(f.read(4 * header['num_embedding']), dtype=np.uint32).astype(np.int64)
+        stream_size = np.frombuffer(f.read(4 * header['num_lanes']), dtype=np.uint32)
+        stream = [np.frombuffer(f.read(4 * int(n)), dtype=np.uint32) for n in stream_size]
+    code = decompress(header, freq, stream)
+    return code, header
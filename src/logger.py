@@ -1,8 +1,12 @@
+import json
+import os
+import torch
+import torch.distributed as dist
 from collections import defaultdict
 from collections.abc import Iterable
 from torch.utils.tensorboard import SummaryWriter
 from numbers import Number
-from utils import ntuple
+from utils import ntuple, is_main_process, makedir_exist_ok
 
 
 class Logger():
@@ -12,20 +16,34 @@ class Logger():
         self.tracker = defaultdict(int)
         self.counter = defaultdict(int)
         self.mean = defaultdict(int)
-        self.history = defaultdict(list)
         self.iterator = defaultdict(int)
 
     def safe(self, write):
         if write:
-            self.writer = SummaryWriter(self.log_path)
+            if is_main_process():
+                self.writer = SummaryWriter(self.log_path)
         else:
             if self.writer is not None:
                 self.writer.close()
                 self.writer = None
-            for name in self.mean:
-                self.history[name].append(self.mean[name])
+            if len(self.mean) > 0 and is_main_process():
+                # one line per call instead of a growing history pickled with every checkpoint
+                makedir_exist_ok(self.log_path)
+                with open(os.path.join(self.log_path, 'history.jsonl'), 'a') as f:
+                    f.write(json.dumps(self.mean) + '\n')
         return
 
+    @property
+    def history(self):
+        history = defaultdict(list)
+        history_path = os.path.join(self.log_path, 'history.jsonl')
+        if os.path.exists(history_path):
+            with open(history_path, 'r') as f:
+                for line in f:
+                    for name, value in json.loads(line).items():
+                        history[name].append(value)
+        return history
+
     def reset(self):
         self.tracker = defaultdict(int)
         self.counter = defaultdict(int)
@@ -77,12 +95,40 @@ class Logger():
         info = self.tracker[info_name]
         info[2:2] = evaluation_info
         info = '  '.join(info)
-        print(info)
+        if is_main_process():
+            print(info)
         if self.writer is not None:
             self.iterator[info_name] += 1
             self.writer.add_text(info_name, info, self.iterator[info_name])
         return
 
+    def synchronize(self):
+        # running means of all replicas, weighted by their counts
+        if not dist.is_initialized():
+            return
+        names = sorted(name for name in self.mean if isinstance(self.mean[name], Number))
+        device = 'cuda' if dist.get_backend() == 'nccl' else 'cpu'
+        stats = torch.tensor([[self.counter[name] * self.mean[name], self.counter[name]] for name in names],
+                             dtype=torch.float64, device=device)
+        dist.all_reduce(stats)
+        for name, (s, n) in zip(names, stats.tolist()):
+            self.mean[name] = s / n if n > 0 else 0
+            self.counter[name] = int(n)
+        return
+
+    def histogram(self, name, count):
+        # count[i] is the usage of bin i
+        if self.writer is not None:
+            self.iterator[name] += 1
+            count = count.detach().cpu().double()
+            index = torch.arange(len(count), dtype=torch.double)
+            self.writer.add_histogram_raw(name, min=0, max=len(count) - 1, num=count.sum().item(),
+                                          sum=(index * count).sum().item(),
+                                          sum_squares=(index.pow(2) * count).sum().item(),
+                                          bucket_limits=(index + 1).tolist(), bucket_counts=count.tolist(),
+                                          global_step=self.iterator[name])
+        return
+
     def flush(self):
         self.writer.flush()
         return
\ No newline at end of file
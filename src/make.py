@@ -11,6 +11,8 @@ parser.add_argument('--experiments_step', default=1, type=int)
 parser.add_argument('--num_experiments', default=1, type=int)
 parser.add_argument('--num_epochs', default=200, type=int)
 parser.add_argument('--resume_mode', default=0, type=int)
+parser.add_argument('--world_size', default=1, type=int)
+parser.add_argument('--device', default='cuda', type=str)
 args = vars(parser.parse_args())
 
 
@@ -24,6 +26,8 @@ def main():
     num_experiments = args['num_experiments']
     num_epochs = args['num_epochs']
     resume_mode = args['resume_mode']
+    world_size = args['world_size']
+    device = args['device']
     gpu_ids = [str(x) for x in list(range(num_gpus))]
     if run in ['train', 'test']:
         filename = '{}_{}'.format(run, model)
@@ -50,9 +54,20 @@ def main():
     controls = list(itertools.product(*controls))
     for i in range(len(controls)):
         controls[i] = list(controls[i])
-        s = s + 'CUDA_VISIBLE_DEVICES=\"{}\" python {} --data_name {} --model_name {} --init_seed {} ' \
-                '--num_experiments {} --num_epochs {} --resume_mode {} --control_name {}&\n'.format(
-            gpu_ids[k % len(gpu_ids)], *controls[i])
+        if run == 'train' and world_size > 1:
+            # one process per replica, concurrent runs need their own rendezvous port
+            launcher = 'torchrun --nproc_per_node {} --master_port {}'.format(world_size, 29500 + k % round)
+        else:
+            launcher = 'python'
+        num_replicas = world_size if run == 'train' else 1
+        if device == 'cuda':
+            visible_devices = ','.join(gpu_ids[(k * num_replicas + j) % len(gpu_ids)] for j in range(num_replicas))
+            s = s + 'CUDA_VISIBLE_DEVICES=\"{}\" '.format(visible_devices)
+        s = s + '{} {} --data_name {} --model_name {} --init_seed {} --num_experiments {} --num_epochs {} ' \
+                '--resume_mode {} --control_name {} --device {}'.format(launcher, *controls[i], device)
+        if run == 'train':
+            s = s + ' --world_size {}'.format(world_size)
+        s = s + '&\n'
         if k % round == round - 1:
             s = s[:-2] + '\nwait\n'
         k = k + 1
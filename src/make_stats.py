@@ -11,7 +11,7 @@ if __name__ == "__main__":
     cfg['seed'] = 0
     cfg['tag'] = {'batch_size': {'train': 1, 'test': 1}}
     for data_name in data_names:
-        dataset = fetch_dataset(cfg['data_name'], cfg['subset'])
+        dataset = fetch_dataset(cfg['data_name'], cfg['subset'], ['uvw'])
         process_dataset(dataset['train'])
         data_loader = make_data_loader(dataset)
         stats = Stats(dim=dim)
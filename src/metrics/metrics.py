@@ -2,7 +2,7 @@ import torch
 import torch.nn.functional as F
 from config import cfg
 from utils import recur
-from models.utils import physics, weighted_mse_loss, ssim3D
+from models.utils import make_physics_memory, physics, weighted_mse_loss, uniform_weight, ssim3D
 
 
 def MSE(output, target):
@@ -11,11 +11,27 @@ def MSE(output, target):
     return mse
 
 
+def D_MSE(output, target):
+    with torch.no_grad():
+        mse = weighted_mse_loss(output, target, uniform_weight).item()
+    return mse
+
+
 def Physics(output, target):
-    phy = physics(output, target).item()
+    phy = physics(output, target, make_physics_memory()).item()
     return phy
 
 
+def code_usage(code, num_embedding):
+    # perplexity and number of used codes, averaged over the stages of residual codes
+    code = code.transpose(0, 1).reshape(code.size(1), -1) if code.dim() == 5 else code.reshape(1, -1)
+    count = torch.stack([torch.bincount(code_s, minlength=num_embedding) for code_s in code]).float()
+    p = count / count.sum(1, keepdim=True)
+    perplexity = torch.exp(-torch.sum(p * torch.log(p.clamp(min=1e-10)), dim=1)).mean()
+    active_code = (count > 0).float().sum(1).mean()
+    return perplexity, active_code
+
+
 def PSNR(output, target):
     with torch.no_grad():
         mse = F.mse_loss(output, target, reduction='mean')
@@ -35,22 +51,73 @@ def MSSIM(output, target):
     return mssim
 
 
+def add_code_usage(metric_names, output):
+    # perplexity and active codes share one bincount over all codes
+    if 'Perplexity' in metric_names or 'Active_Code' in metric_names:
+        with torch.no_grad():
+            output = {**output, 'code_usage': code_usage(output['code'], cfg['vqvae']['num_embedding'])}
+    return output
+
 
 class Metric(object):
     def __init__(self):
         self.metric = {}
         self.metric['Loss'] = lambda input, output: output['loss'].item()
         self.metric['MSE'] = lambda input, output: recur(MSE, output[cfg['subset']], input[cfg['subset']])
-        self.metric['D_MSE'] = lambda input, output: recur(MSE, output['d{}'.format(cfg['subset'])],
+        self.metric['D_MSE'] = lambda input, output: recur(D_MSE, output['d{}'.format(cfg['subset'])],
                                                            input['d{}'.format(cfg['subset'])])
         self.metric['Physics'] = lambda input, output: recur(Physics, output['d{}'.format(cfg['subset'])],
                                                             input['d{}'.format(cfg['subset'])])
+        self.metric['Perplexity'] = lambda input, output: output['code_usage'][0].item()
+        self.metric['Active_Code'] = lambda input, output: output['code_usage'][1].item()
         self.metric['PSNR'] = lambda input, output: recur(PSNR, output[cfg['subset']], input[cfg['subset']])
         self.metric['MAE'] = lambda input, output: recur(MAE, output[cfg['subset']], input[cfg['subset']])
         self.metric['MSSIM'] = lambda input, output: recur(MSSIM, output[cfg['subset']], input[cfg['subset']])
 
     def evaluate(self, metric_names, input, output):
+        output = add_code_usage(metric_names, output)
         evaluation = {}
         for metric_name in metric_names:
             evaluation[metric_name] = self.metric[metric_name](input, output)
-        return evaluation
\ No newline at end of file
+        return evaluation
+
+
+class Accumulator(object):
+    # running sums stay on the device, the host syncs once per pop instead of once per metric and step
+    def __init__(self, metric_names):
+        self.metric_names = metric_names
+        self.metric = {}
+        self.metric['Loss'] = lambda input, output: output['loss']
+        self.metric['MSE'] = lambda input, output: output['mse'] if 'mse' in output else \
+            F.mse_loss(output[cfg['subset']], input[cfg['subset']])
+        # the forward only computes the unweighted component mean of the derivative error for the exact loss
+        self.metric['D_MSE'] = lambda input, output: output['d_mse'] \
+            if 'exact' in cfg['d_mode'] and 'd_mse' in output else \
+            weighted_mse_loss(output['d{}'.format(cfg['subset'])], input['d{}'.format(cfg['subset'])], uniform_weight)
+        self.metric['Physics'] = lambda input, output: output['physics'] if 'physics' in output else \
+            physics(output['d{}'.format(cfg['subset'])], input['d{}'.format(cfg['subset'])], make_physics_memory())
+        self.metric['Perplexity'] = lambda input, output: output['code_usage'][0]
+        self.metric['Active_Code'] = lambda input, output: output['code_usage'][1]
+        self.reset()
+
+    def reset(self):
+        self.sum = None
+        self.n = 0
+        return
+
+    def add(self, input, output, n=1):
+        with torch.no_grad():
+            output = add_code_usage(self.metric_names, output)
+            evaluation = torch.stack([self.metric[metric_name](input, output).float()
+                                      for metric_name in self.metric_names]) * n
+            self.sum = evaluation if self.sum is None else self.sum + evaluation
+        self.n += n
+        return
+
+    def pop(self):
+        if self.n == 0:
+            return {}, 0
+        evaluation = dict(zip(self.metric_names, (self.sum / self.n).tolist()))
+        n = self.n
+        self.reset()
+        return evaluation, n
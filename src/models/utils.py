@@ -1,8 +1,10 @@
+import math
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from math import exp
+from torch.utils.checkpoint import checkpoint
 from config import cfg
 
 
@@ -13,41 +15,89 @@ def init_param(m):
     return m
 
 
-def normalize(input):
-    broadcast_size = [1] * input.dim()
-    broadcast_size[1] = input.size(1)
-    m, s = cfg['stats'][cfg['data_name']]
-    m, s = torch.tensor(m, dtype=input.dtype).view(broadcast_size).to(input.device), \
-           torch.tensor(s, dtype=input.dtype).view(broadcast_size).to(input.device)
-    input = input.sub(m).div(s)
-    return input
+wavenumber_cache = {}
 
 
-def denormalize(input):
-    broadcast_size = [1] * input.dim()
-    broadcast_size[1] = input.size(1)
-    m, s = cfg['stats'][cfg['data_name']]
-    m, s = torch.tensor(m, dtype=input.dtype).view(broadcast_size).to(input.device), \
-           torch.tensor(s, dtype=input.dtype).view(broadcast_size).to(input.device)
-    input = input.mul(s).add(m)
-    return input
+def make_wavenumber(size, dtype, device):
+    key = (tuple(size), dtype, str(device))
+    if key not in wavenumber_cache:
+        wavenumber = []
+        for i in range(3):
+            k = np.fft.rfftfreq(size[i], 1. / size[i]) if i == 2 else np.fft.fftfreq(size[i], 1. / size[i])
+            # the Nyquist mode of a real field has no resolvable derivative
+            if size[i] % 2 == 0:
+                k[size[i] // 2] = 0
+            broadcast_size = [1, 1, 1]
+            broadcast_size[i] = len(k)
+            wavenumber.append(torch.tensor(k, dtype=dtype, device=device).view(broadcast_size)
+                              .expand(size[0], size[1], size[2] // 2 + 1))
+        wavenumber_cache[key] = torch.stack(wavenumber, dim=0) * 1j
+    return wavenumber_cache[key]
 
 
-def spectral_derivative_3d(V):
+def spectral_derivative_3d(V, memory=None):
+    # FFTs run in float32 when the field comes out of an autocast region
+    V = V.float() if V.dtype in [torch.float16, torch.bfloat16] else V
     N, C, H, W, D = V.size()
-    h = np.fft.fftfreq(H, 1. / H)
-    w = np.fft.fftfreq(W, 1. / W)
-    d = np.fft.fftfreq(D, 1. / D)
-    mesh_h, mesh_w, mesh_d = torch.tensor(np.meshgrid(h, w, d, indexing='ij'), device=V.device, dtype=V.dtype)
-    V_fft = torch.rfft(V, signal_ndim=3, onesided=False)
-    V_fft_hat = torch.stack([-V_fft[..., 1], V_fft[..., 0]], dim=-1)
-    dV_dh = torch.irfft(V_fft_hat * mesh_h.unsqueeze(-1), signal_ndim=3, onesided=False)
-    dV_dw = torch.irfft(V_fft_hat * mesh_w.unsqueeze(-1), signal_ndim=3, onesided=False)
-    dV_dd = torch.irfft(V_fft_hat * mesh_d.unsqueeze(-1), signal_ndim=3, onesided=False)
-    dV = torch.stack([dV_dh, dV_dw, dV_dd], dim=2)
+    ik = make_wavenumber((H, W, D), V.dtype, V.device)
+    if memory is None:
+        V_fft = torch.fft.rfftn(V, dim=(2, 3, 4))
+        dV = torch.fft.irfftn(V_fft.unsqueeze(2) * ik, s=(H, W, D), dim=(3, 4, 5))
+        return dV
+    # each velocity component holds its spectrum and three derivative spectra at once
+    chunk_size = max(1, int(memory // (4 * H * W * (D // 2 + 1) * 2 * V.element_size())))
+    V = V.reshape(N * C, 1, H, W, D)
+    dV = []
+    for i in range(0, N * C, chunk_size):
+        V_fft = torch.fft.rfftn(V[i:i + chunk_size], dim=(2, 3, 4))
+        dV.append(torch.fft.irfftn(V_fft.unsqueeze(2) * ik, s=(H, W, D), dim=(3, 4, 5)))
+    dV = torch.cat(dV, dim=0).view(N, C, 3, H, W, D)
+    return dV
+
+
+def finite_derivative_3d(V, spacing):
+    dV = torch.stack(torch.gradient(V, spacing=spacing, dim=(2, 3, 4)), dim=2)
+    return dV
+
+
+def derivative_3d(V, periodic=True, memory=None):
+    if periodic:
+        dV = spectral_derivative_3d(V, memory)
+    else:
+        dV = finite_derivative_3d(V, 2 * np.pi / cfg['data_shape'][1])
     return dV
 
 
+def periodic_crop(input, start, size, dims):
+    for i in range(len(dims)):
+        crop_idx = torch.arange(start[i], start[i] + size[i], device=input.device) % input.size(dims[i])
+        input = input.index_select(dims[i], crop_idx)
+    return input
+
+
+def make_receptive_field(module):
+    radius, scale, size = 0, 1, 0
+    for m in module.modules():
+        if isinstance(m, nn.Conv3d):
+            radius += max(m.padding[0], m.kernel_size[0] - 1 - m.padding[0]) / scale
+            scale = scale / m.stride[0]
+            size = max(size, m.out_channels * scale ** 3)
+        elif isinstance(m, nn.ConvTranspose3d):
+            radius += math.ceil(max(m.padding[0], m.kernel_size[0] - 1 - m.padding[0]) / m.stride[0]) / scale
+            scale = scale * m.stride[0]
+            size = max(size, m.out_channels * scale ** 3)
+    return radius, size
+
+
+def make_tile_size(length, halo, stride, size, memory):
+    # activations are float32 and each layer holds its input and output at once
+    tile_size = int((memory / (2 * 4 * size)) ** (1 / 3)) - 2 * halo
+    tile_size = min(tile_size // stride * stride, length)
+    if tile_size < stride:
+        raise ValueError('Not valid memory budget')
+    return tile_size
+
+
 def physics_old(A):
     A11, A22, A33 = A[:, 0, 0], A[:, 1, 1], A[:, 2, 2]
     continuity = (A11 + A22 + A33).mean()
@@ -71,39 +121,74 @@ def physics_old(A):
     return output
 
 
-def physics(A_model, A_target):
-    # continuity = [None, None]
-    S_ijS_ij_m = [None, None]
-    R_ijR_ij_m = [None, None]
-    SijSkjSji_m = [None, None]
-    VortexStret_m = [None, None]
-    for i, A in enumerate([A_model, A_target]):
-        A11, A22, A33 = A[:, 0, 0], A[:, 1, 1], A[:, 2, 2]
-        # continuity[i] = (A11 + A22 + A33).mean()
-        S = 0.5 * (A + A.transpose(1, 2))
-        R = 0.5 * (A - A.transpose(1, 2))
-        S_ijS_ij = (S * S).sum(dim=[1, 2])
-        R_ijR_ij = (R * R).sum(dim=[1, 2])
-        S_ijS_ij_m[i] = S_ijS_ij.mean()
-        R_ijR_ij_m[i] = R_ijR_ij.mean()
-
-        S = S.permute(0, 3, 4, 5, 1, 2).reshape(-1, 3, 3)
-        R = R.permute(0, 3, 4, 5, 1, 2).reshape(-1, 3, 3)
-        SijSkjSji = torch.sum(torch.matmul(S, S) * S, axis=(1, 2))
-        Omega = torch.empty((*R.size()[:-1], 1), device=R.device)
-        Omega[:, 0, 0] = 2 * R[:, 2, 1]
-        Omega[:, 1, 0] = 2 * R[:, 0, 2]
-        Omega[:, 2, 0] = 2 * R[:, 1, 0]
-        VS_3d = torch.matmul(S, Omega)
-        VortexStret = torch.matmul(Omega.transpose(1, 2), VS_3d)
-        SijSkjSji_m[i] = SijSkjSji.mean()
-        VortexStret_m[i] = (-3 / 4) * VortexStret.mean()
-
-    weight = torch.tensor([1, 1, 1, 1], device=A_model.device)
-    output = 0
-    for i, item in enumerate([S_ijS_ij_m, R_ijR_ij_m, SijSkjSji_m, VortexStret_m]):
-        output += (item[1] - item[0]).abs() * weight[i]
+def make_physics_memory():
+    return cfg['physics_memory'] * 2 ** 20 if cfg['physics_memory'] > 0 else None
+
+
+def invariants(A, keys=('Trace_A', 'Q', 'R', 'S_ijS_ij', 'R_ijR_ij', 'VS', 'SijSkjSji')):
+    # A[i][j] indexes the velocity gradient components, e.g. (N,3,3,H,W,D) tensors or nested lists of arrays
+    a = [[A[i][j] for j in range(3)] for i in range(3)] if isinstance(A, (list, tuple)) else \
+        [[A[:, i, j] for j in range(3)] for i in range(3)]
+    s00, s11, s22 = a[0][0], a[1][1], a[2][2]
+    s01, s02, s12 = 0.5 * (a[0][1] + a[1][0]), 0.5 * (a[0][2] + a[2][0]), 0.5 * (a[1][2] + a[2][1])
+    w0, w1, w2 = a[2][1] - a[1][2], a[0][2] - a[2][0], a[1][0] - a[0][1]
+    output = {}
+    if 'Trace_A' in keys:
+        output['Trace_A'] = s00 + s11 + s22
+    if 'Q' in keys:
+        output['Q'] = -0.5 * (s00 * s00 + s11 * s11 + s22 * s22) - (
+                a[0][1] * a[1][0] + a[0][2] * a[2][0] + a[1][2] * a[2][1])
+    if 'R' in keys:
+        output['R'] = (-1 / 3) * (s00 * s00 * s00 + s11 * s11 * s11 + s22 * s22 * s22) - (
+                (s00 + s11) * a[0][1] * a[1][0] + (s00 + s22) * a[0][2] * a[2][0] +
+                (s11 + s22) * a[1][2] * a[2][1] + a[0][1] * a[1][2] * a[2][0] + a[0][2] * a[2][1] * a[1][0])
+    if 'S_ijS_ij' in keys:
+        output['S_ijS_ij'] = s00 * s00 + s11 * s11 + s22 * s22 + 2 * (s01 * s01 + s02 * s02 + s12 * s12)
+    if 'R_ijR_ij' in keys:
+        output['R_ijR_ij'] = 0.5 * (w0 * w0 + w1 * w1 + w2 * w2)
+    if 'VS' in keys:
+        output['VS'] = s00 * w0 * w0 + s11 * w1 * w1 + s22 * w2 * w2 + 2 * (
+                s01 * w0 * w1 + s02 * w0 * w2 + s12 * w1 * w2)
+    if 'SijSkjSji' in keys:
+        output['SijSkjSji'] = s00 * s00 * s00 + s11 * s11 * s11 + s22 * s22 * s22 + 3 * (
+                (s00 + s11) * s01 * s01 + (s00 + s22) * s02 * s02 + (s11 + s22) * s12 * s12) + 6 * s01 * s02 * s12
+    return output
+
+
+def invariant_sum(A):
+    output = invariants(A, ('S_ijS_ij', 'R_ijR_ij', 'SijSkjSji', 'VS'))
+    return output['S_ijS_ij'].sum(), output['R_ijR_ij'].sum(), output['SijSkjSji'].sum(), \
+           (-3 / 4) * output['VS'].sum()
+
+
+def invariant_mean(A, memory=None):
+    N, _, _, H, W, D = A.size()
+    if memory is None:
+        chunk_size = H
+    else:
+        # strain, vorticity and elementwise products per grid point
+        chunk_size = max(1, min(H, int(memory // (32 * W * D * A.element_size()))))
+    output = [0, 0, 0, 0]
+    for n in range(N):
+        for h in range(0, H, chunk_size):
+            A_i = A[n:n + 1, :, :, h:h + chunk_size]
+            if memory is not None and A_i.requires_grad:
+                output_i = checkpoint(invariant_sum, A_i)
+            else:
+                output_i = invariant_sum(A_i)
+            for j in range(len(output)):
+                output[j] = output[j] + output_i[j]
+    output = [x / (N * H * W * D) for x in output]
+    return output
 
+
+def physics(A_model, A_target, memory=None):
+    invariant_model = invariant_mean(A_model, memory)
+    invariant_target = invariant_mean(A_target, memory)
+    weight = [1, 1, 1, 1]
+    output = 0
+    for i in range(len(weight)):
+        output += (invariant_target[i] - invariant_model[i]).abs() * weight[i]
     return output
 
 
@@ -113,9 +198,35 @@ def physics(A_model, A_target):
 #     loss = (loss * weight).mean()
 #     return loss
 
-def weighted_mse_loss(input, target, weight=(2. * torch.ones(3, 3)).fill_diagonal_(1)):
-    loss_ = nn.functional.mse_loss(input, target, reduction='none')
-    return sum([(weight[i, j] * loss_[:, i, j]).mean() for i in range(3) for j in range(3)])
+gradient_weight = ((1., 2., 2.), (2., 1., 2.), (2., 2., 1.))
+uniform_weight = ((1 / 9, 1 / 9, 1 / 9),) * 3
+mse_weight_cache = {}
+
+
+def make_mse_weight(weight, dtype, device):
+    key = (weight, dtype, str(device))
+    if key not in mse_weight_cache:
+        mse_weight_cache[key] = torch.tensor(weight, dtype=dtype, device=device)
+    return mse_weight_cache[key]
+
+
+def component_mse_loss(input, target, chunk_size=2 ** 16):
+    # mean(|input_ij - target_ij|^2) of each gradient component, squared in chunks of grid points so the error is
+    # the only full size temporary, a float32 einsum/bmm/vector_norm reduction loses accuracy on large grids
+    N = input.size(0)
+    error = (input - target).flatten(3)
+    loss = 0
+    for error_i in error.split(chunk_size, -1):
+        loss = loss + (error_i * error_i).sum(-1)
+    loss = loss.sum(0) / (N * error.size(-1))
+    return loss
+
+
+def weighted_mse_loss(input, target, weight=gradient_weight, loss=None):
+    # sum_ij weight_ij * mean(|input_ij - target_ij|^2), loss reuses already computed component errors
+    loss = component_mse_loss(input, target) if loss is None else loss
+    loss = (loss * make_mse_weight(weight, input.dtype, input.device)).sum()
+    return loss
 
 
 def gaussian(window_size, sigma):
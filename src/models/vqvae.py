@@ -1,9 +1,11 @@
+import math
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from config import cfg
-from modules import VectorQuantization
-from .utils import init_param, spectral_derivative_3d, physics, weighted_mse_loss, normalize, denormalize
+from modules import Normalization, VectorQuantization, ResidualVectorQuantization
+from .utils import init_param, spectral_derivative_3d, derivative_3d, make_physics_memory, physics, weighted_mse_loss, \
+    component_mse_loss, periodic_crop, make_receptive_field, make_tile_size
 
 
 class ResBlock(nn.Module):
@@ -109,11 +111,20 @@ class Decoder(nn.Module):
 
 class VQVAE(nn.Module):
     def __init__(self, input_size=3, hidden_size=128, depth=2, num_res_block=2, res_size=32, embedding_size=64,
-                 num_embedding=512, d_mode='exact', d_commit=None, vq_commit=0.25, loss_power_vg=2):
+                 num_embedding=512, d_mode='exact', d_commit=None, vq_commit=0.25, loss_power_vg=2, stats=None,
+                 vq_memory=None, vq_search='exact', num_stage=1, restart_threshold=0):
         super().__init__()
+        self.normalization = Normalization(input_size, stats)
         self.encoder = Encoder(input_size, hidden_size, embedding_size, num_res_block, res_size, stride=2 ** depth)
-        self.quantizer = VectorQuantization(embedding_size, num_embedding, vq_commit)
+        if num_stage == 1:
+            self.quantizer = VectorQuantization(embedding_size, num_embedding, vq_commit, memory=vq_memory,
+                                                search=vq_search, restart_threshold=restart_threshold)
+        else:
+            self.quantizer = ResidualVectorQuantization(embedding_size, num_embedding, vq_commit, num_stage,
+                                                        memory=vq_memory, search=vq_search,
+                                                        restart_threshold=restart_threshold)
         self.decoder = Decoder(embedding_size, input_size, hidden_size, num_res_block, res_size, stride=2 ** depth)
+        self.stride = 2 ** depth
         self.d_mode = d_mode
         self.d_commit = d_commit
         self.loss_power = loss_power_vg
@@ -124,31 +135,101 @@ class VQVAE(nn.Module):
         quantized, diff, code = self.quantizer(encoded)
         return quantized, diff, code
 
+    def encode_code(self, input):
+        encoded = self.encoder(self.normalization(input))
+        code = self.quantizer.encode(encoded)
+        return code
+
     def decode(self, quantized):
         decoded = self.decoder(quantized)
         return decoded
 
     def decode_code(self, code):
+        # velocities in data space, fused or not
         quantized = self.quantizer.embedding_code(code).transpose(1, -1).contiguous()
-        decoded = self.decode(quantized)
+        decoded = self.normalization.denormalize(self.decode(quantized))
+        return decoded
+
+    def make_quantizers(self):
+        return list(self.quantizer.stage) if isinstance(self.quantizer, ResidualVectorQuantization) else \
+            [self.quantizer]
+
+    def fuse_normalization(self):
+        self.normalization.fuse(self.decoder.blocks[-1])
+        return
+
+    def encode_tiled(self, input, memory):
+        input = self.normalization(input)
+        N, _, H, W, D = input.size()
+        radius, size = make_receptive_field(self.encoder)
+        halo = math.ceil(radius / self.stride) * self.stride
+        tile_size = make_tile_size(max(H, W, D), halo, self.stride, N * size, memory)
+        code = None
+        c = halo // self.stride
+        for h in range(0, H, tile_size):
+            for w in range(0, W, tile_size):
+                for d in range(0, D, tile_size):
+                    t_h, t_w, t_d = min(tile_size, H - h), min(tile_size, W - w), min(tile_size, D - d)
+                    x = periodic_crop(input, [h - halo, w - halo, d - halo],
+                                      [t_h + 2 * halo, t_w + 2 * halo, t_d + 2 * halo], [2, 3, 4])
+                    encoded = self.encoder(x)
+                    encoded = encoded[:, :, c:c + t_h // self.stride, c:c + t_w // self.stride,
+                              c:c + t_d // self.stride]
+                    code_i = self.quantizer.encode(encoded).movedim(-3, -1)
+                    if code is None:
+                        code = torch.empty((*code_i.size()[:-3], H // self.stride, W // self.stride,
+                                            D // self.stride), dtype=torch.long, device=input.device)
+                    code[..., h // self.stride:(h + t_h) // self.stride, w // self.stride:(w + t_w) // self.stride,
+                    d // self.stride:(d + t_d) // self.stride] = code_i
+        code = code.movedim(-1, -3).contiguous()
+        return code
+
+    def decode_code_tiled(self, code, memory):
+        code = code.movedim(-3, -1)
+        N = code.size(0)
+        H, W, D = code.size()[-3:]
+        radius, size = make_receptive_field(self.decoder)
+        halo = math.ceil(radius)
+        tile_size = make_tile_size(max(H, W, D), halo, 1, N * size, memory)
+        decoded = None
+        for h in range(0, H, tile_size):
+            for w in range(0, W, tile_size):
+                for d in range(0, D, tile_size):
+                    t_h, t_w, t_d = min(tile_size, H - h), min(tile_size, W - w), min(tile_size, D - d)
+                    code_i = periodic_crop(code, [h - halo, w - halo, d - halo],
+                                           [t_h + 2 * halo, t_w + 2 * halo, t_d + 2 * halo], [-3, -2, -1])
+                    decoded_i = self.decode_code(code_i.movedim(-1, -3))
+                    if decoded is None:
+                        decoded = decoded_i.new_empty((N, decoded_i.size(1), H * self.stride, W * self.stride,
+                                                       D * self.stride))
+                    s, c = self.stride, halo * self.stride
+                    decoded[:, :, h * s:(h + t_h) * s, w * s:(w + t_w) * s, d * s:(d + t_d) * s] = \
+                        decoded_i[:, :, c:c + t_h * s, c:c + t_w * s, c:c + t_d * s]
         return decoded
 
-    def forward(self, input, Epoch=None):
+    def forward(self, input, Epoch=None, periodic=True):
         output = {'loss': torch.tensor(0, device=cfg['device'], dtype=torch.float32)}
         x = input['uvw']
-        x = normalize(x)
+        x = self.normalization(x)
         quantized, diff, output['code'] = self.encode(x)
-        decoded = self.decode(quantized)
-        decoded = denormalize(decoded)
+        decoded = self.decode(quantized).float()
+        decoded = self.normalization.denormalize(decoded)
         output['uvw'] = decoded
-        output['duvw'] = spectral_derivative_3d(output['uvw'])
-        output['loss'] = F.mse_loss(output['uvw'], input['uvw']) + diff
+        output['duvw'] = derivative_3d(output['uvw'], periodic, make_physics_memory())
+        mse = F.mse_loss(output['uvw'], input['uvw'])
+        output['loss'] = mse + diff
+        # loss terms are kept detached so the training metrics do not recompute them
+        output['mse'] = mse.detach()
         for i in range(len(self.d_mode)):
             if self.d_mode[i] == 'exact':
-                output['loss'] += self.d_commit[i] * weighted_mse_loss(output['duvw'], input['duvw'])
+                d_mse = component_mse_loss(output['duvw'], input['duvw'])
+                output['loss'] += self.d_commit[i] * weighted_mse_loss(output['duvw'], input['duvw'], loss=d_mse)
+                output['d_mse'] = d_mse.detach().mean()
             elif self.d_mode[i] == 'physics':
                 if Epoch and (Epoch > 25):
-                    output['loss'] += self.d_commit[i] * physics(output['duvw'], input['duvw'])
+                    phy = physics(output['duvw'], input['duvw'], make_physics_memory())
+                    output['loss'] += self.d_commit[i] * phy
+                    output['physics'] = phy.detach()
             else:
                 raise ValueError('Not valid d_mode')
         return output
@@ -165,8 +246,12 @@ def vqvae():
     d_mode = cfg['d_mode']
     d_commit = cfg['d_commit']
     vq_commit = cfg['vqvae']['vq_commit']
+    stats = cfg['stats'][cfg['data_name']]
+    vq_memory = cfg['vq_memory'] * 2 ** 20 if cfg['vq_memory'] > 0 else None
     model = VQVAE(input_size=data_shape[0], hidden_size=hidden_size, depth=depth, num_res_block=num_res_block,
                   res_size=res_size, embedding_size=embedding_size, num_embedding=num_embedding,
-                  d_mode=d_mode, d_commit=d_commit, vq_commit=vq_commit)
+                  d_mode=d_mode, d_commit=d_commit, vq_commit=vq_commit, stats=stats,
+                  vq_memory=vq_memory, vq_search=cfg['vq_search'],
+                  num_stage=cfg['vqvae']['num_stage'], restart_threshold=cfg['restart_threshold'])
     model.apply(init_param)
     return model
\ No newline at end of file
@@ -1 +1,2 @@
 from .modules import *
+from .search import *
@@ -1,47 +1,174 @@
 import torch
+import torch.distributed as dist
 import torch.nn as nn
 import torch.nn.functional as F
+from .search import make_search
+
+
+class Normalization(nn.Module):
+    def __init__(self, size, stats=None):
+        super().__init__()
+        m, s = ([0.] * size, [1.] * size) if stats is None else stats
+        self.register_buffer('mean', torch.tensor(m, dtype=torch.float32).view(1, size, 1, 1, 1), persistent=False)
+        self.register_buffer('std', torch.tensor(s, dtype=torch.float32).view(1, size, 1, 1, 1), persistent=False)
+        self.fused = False
+
+    def forward(self, input):
+        return input.sub(self.mean).div(self.std)
+
+    def denormalize(self, input):
+        if self.fused:
+            return input
+        return input.mul(self.std).add(self.mean)
+
+    def fuse(self, conv_out):
+        # fold the denormalization into the last transposed conv (out channels) for inference, exact everywhere
+        # the input normalization stays explicit, folded into the first conv its mean would be wrong wherever the
+        # conv reads zero padding
+        if self.fused:
+            return
+        with torch.no_grad():
+            conv_out.weight.mul_(self.std)
+            conv_out.bias.mul_(self.std.view(-1)).add_(self.mean.view(-1))
+        self.fused = True
+        return
 
 
 class VectorQuantization(nn.Module):
-    def __init__(self, embedding_size, num_embedding, vq_commit, decay=0.99, eps=1e-5):
+    def __init__(self, embedding_size, num_embedding, vq_commit, decay=0.99, eps=1e-5, memory=None, search='exact',
+                 restart_threshold=0):
         super().__init__()
         self.embedding_size = embedding_size
         self.num_embedding = num_embedding
         self.decay = decay
         self.eps = eps
+        self.searcher = make_search(search, memory)
+        self.restart_threshold = restart_threshold
         embedding = torch.randn(self.embedding_size, self.num_embedding)
         self.register_buffer('embedding', embedding)
         self.register_buffer('cluster_size', torch.zeros(self.num_embedding))
         self.register_buffer('embedding_mean', embedding.clone())
+        self.register_buffer('embedding_norm', embedding.pow(2).sum(0), persistent=False)
         self.vq_commit = vq_commit
 
+    def _load_from_state_dict(self, *args, **kwargs):
+        super()._load_from_state_dict(*args, **kwargs)
+        self.update_embedding_norm()
+        self.searcher.reset()
+        return
+
+    def update_embedding_norm(self):
+        self.embedding_norm.copy_(self.embedding.pow(2).sum(0))
+        return
+
+    def restart(self, flatten):
+        # reseed codes whose EMA usage fell below the threshold from the current encoder outputs
+        dead = torch.nonzero(self.cluster_size < self.restart_threshold).squeeze(1)
+        if dead.numel() == 0:
+            return
+        sample = flatten[torch.randint(flatten.size(0), (dead.numel(),), device=flatten.device)].t()
+        self.embedding.data[:, dead] = sample
+        self.embedding_mean.data[:, dead] = sample
+        self.cluster_size.data[dead] = 1
+        if dist.is_initialized():
+            # replicas draw different samples, keep the codebook of the first one
+            for buffer in [self.embedding, self.embedding_mean, self.cluster_size]:
+                dist.broadcast(buffer.data, 0)
+        return
+
+    def search(self, flatten):
+        # distances stay in float32 under autocast, reduced precision flips near ties
+        with torch.no_grad(), torch.autocast(flatten.device.type, enabled=False):
+            embedding_ind = self.searcher(flatten, self.embedding, self.embedding_norm)
+        return embedding_ind
+
+    def encode(self, input):
+        input = input.transpose(1, -1).float()
+        embedding_ind = self.search(input.reshape(-1, self.embedding_size)).view(*input.shape[:-1])
+        return embedding_ind
+
     def forward(self, input):
-        input = input.transpose(1, -1).contiguous()
+        input = input.transpose(1, -1).float().contiguous()
         flatten = input.view(-1, self.embedding_size)
-        dist = (
-                flatten.pow(2).sum(1, keepdim=True)
-                - 2 * flatten @ self.embedding
-                + self.embedding.pow(2).sum(0, keepdim=True)
-        )
-        _, embedding_ind = dist.min(1)
-        embedding_onehot = F.one_hot(embedding_ind, self.num_embedding).type(flatten.dtype)
-        embedding_ind = embedding_ind.view(*input.shape[:-1])
-        quantize = self.embedding_code(embedding_ind)
+        embedding_ind = self.search(flatten)
+        quantize = self.embedding_code(embedding_ind.view(*input.shape[:-1]))
         if self.training:
-            self.cluster_size.data.mul_(self.decay).add_(embedding_onehot.sum(0), alpha=1 - self.decay)
-            embedding_sum = flatten.transpose(0, 1) @ embedding_onehot
-            self.embedding_mean.data.mul_(self.decay).add_(embedding_sum, alpha=1 - self.decay)
+            embedding_count = torch.bincount(embedding_ind, minlength=self.num_embedding).type(flatten.dtype)
+            embedding_sum = flatten.new_zeros(self.num_embedding, self.embedding_size).index_add_(
+                0, embedding_ind, flatten.detach())
+            if dist.is_initialized():
+                # EMA statistics of the global batch keep the codebook identical on every replica
+                dist.all_reduce(embedding_count)
+                dist.all_reduce(embedding_sum)
+            self.cluster_size.data.mul_(self.decay).add_(embedding_count, alpha=1 - self.decay)
+            self.embedding_mean.data.mul_(self.decay).add_(embedding_sum.t(), alpha=1 - self.decay)
             n = self.cluster_size.sum()
             cluster_size = (
                     (self.cluster_size + self.eps) / (n + self.num_embedding * self.eps) * n
             )
             embedding_normalized = self.embedding_mean / cluster_size.unsqueeze(0)
             self.embedding.data.copy_(embedding_normalized)
+            if self.restart_threshold > 0:
+                self.restart(flatten.detach())
+            self.update_embedding_norm()
+            self.searcher.update()
+        embedding_ind = embedding_ind.view(*input.shape[:-1])
         diff = self.vq_commit * F.mse_loss(quantize.detach(), input)
         quantize = input + (quantize - input).detach()
         quantize = quantize.transpose(1, -1).contiguous()
         return quantize, diff, embedding_ind
 
     def embedding_code(self, embedding_ind):
-        return F.embedding(embedding_ind, self.embedding.transpose(0, 1))
\ No newline at end of file
+        return F.embedding(embedding_ind, self.embedding.transpose(0, 1))
+
+
+class ResidualVectorQuantization(nn.Module):
+    def __init__(self, embedding_size, num_embedding, vq_commit, num_stage, memory=None, search='exact',
+                 restart_threshold=0):
+        super().__init__()
+        self.num_stage = num_stage
+        self.stage = nn.ModuleList([VectorQuantization(embedding_size, num_embedding, vq_commit, memory=memory,
+                                                       search=search, restart_threshold=restart_threshold)
+                                    for _ in range(num_stage)])
+
+    def forward(self, input, num_stage=None):
+        # training samples the number of stages so every prefix of the codes decodes on its own
+        if num_stage is None:
+            if self.training:
+                num_stage = torch.randint(1, self.num_stage + 1, (1,))
+                if dist.is_initialized():
+                    # every replica has to run the same stages, their EMA updates are collective
+                    num_stage = num_stage.to(input.device)
+                    dist.broadcast(num_stage, 0)
+                num_stage = num_stage.item()
+            else:
+                num_stage = self.num_stage
+        residual = input
+        quantize, diff, embedding_ind = 0, 0, []
+        for i in range(num_stage):
+            quantize_i, diff_i, embedding_ind_i = self.stage[i](residual)
+            residual = residual - quantize_i.detach()
+            quantize = quantize + quantize_i.detach()
+            diff = diff + diff_i
+            embedding_ind.append(embedding_ind_i)
+        quantize = input + (quantize - input).detach()
+        embedding_ind = torch.stack(embedding_ind, dim=1)
+        return quantize, diff, embedding_ind
+
+    def encode(self, input, num_stage=None):
+        num_stage = self.num_stage if num_stage is None else num_stage
+        residual = input
+        embedding_ind = []
+        for i in range(num_stage):
+            embedding_ind_i = self.stage[i].encode(residual)
+            residual = residual - self.stage[i].embedding_code(embedding_ind_i).transpose(1, -1)
+            embedding_ind.append(embedding_ind_i)
+        embedding_ind = torch.stack(embedding_ind, dim=1)
+        return embedding_ind
+
+    def embedding_code(self, embedding_ind):
+        # decodes the first embedding_ind.size(1) stages
+        quantize = 0
+        for i in range(embedding_ind.size(1)):
+            quantize = quantize + self.stage[i].embedding_code(embedding_ind[:, i])
+        return quantize
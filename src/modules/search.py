@@ -0,0 +1,129 @@
+import math
+import torch
+
+
+def nearest(input, centroid, k=1):
+    dist = torch.addmm(centroid.pow(2).sum(1), input, centroid.t(), alpha=-2)
+    if k == 1:
+        return dist.argmin(1)
+    return dist.topk(k, dim=1, largest=False)[1]
+
+
+def kmeans(input, num_cluster, num_iter=10, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    index = torch.randperm(input.size(0), generator=generator)[:num_cluster].to(input.device)
+    centroid = input[index].clone()
+    for _ in range(num_iter):
+        assign = nearest(input, centroid)
+        count = torch.bincount(assign, minlength=num_cluster)
+        total = input.new_zeros(num_cluster, input.size(1)).index_add_(0, assign, input)
+        used = count > 0
+        centroid[used] = total[used] / count[used].unsqueeze(1).type(input.dtype)
+    assign = nearest(input, centroid)
+    return centroid, assign
+
+
+class Search(object):
+    def __init__(self, memory=None):
+        self.memory = memory
+
+    def update(self):
+        return
+
+    def reset(self):
+        return
+
+    def prepare(self, embedding):
+        return
+
+    def row_size(self, embedding):
+        return embedding.size(1)
+
+    def search(self, input, embedding, embedding_norm):
+        dist = torch.addmm(embedding_norm, input, embedding, alpha=-2)
+        return dist.argmin(1)
+
+    def __call__(self, input, embedding, embedding_norm):
+        # |x|^2 is constant per row, so the argmin only needs |e|^2 - 2 x.e, one tile of rows at a time
+        self.prepare(embedding)
+        if self.memory is None:
+            chunk_size = input.size(0)
+        else:
+            chunk_size = max(1, int(self.memory // (self.row_size(embedding) * input.element_size())))
+        embedding_ind = torch.empty(input.size(0), dtype=torch.long, device=input.device)
+        for i in range(0, input.size(0), chunk_size):
+            embedding_ind[i:i + chunk_size] = self.search(input[i:i + chunk_size], embedding, embedding_norm)
+        return embedding_ind
+
+
+class TreeSearch(Search):
+    # two-level hierarchical k-means: rows are grouped by their nearest buckets and each bucket is searched exactly
+    def __init__(self, memory=None, num_probe=8, rebuild_interval=100):
+        super().__init__(memory)
+        self.num_probe = num_probe
+        self.rebuild_interval = rebuild_interval
+        self.reset()
+
+    def update(self):
+        self.num_update += 1
+        return
+
+    def reset(self):
+        self.assign, self.order, self.count, self.start = None, None, None, None
+        self.num_update = 0
+        return
+
+    def build(self, embedding):
+        num_bucket = max(1, int(round(math.sqrt(embedding.size(1)))))
+        _, self.assign = kmeans(embedding.t(), num_bucket)
+        self.order = self.assign.argsort()
+        self.count = torch.bincount(self.assign, minlength=num_bucket)
+        self.start = torch.cumsum(self.count, 0) - self.count
+        self.num_update = 0
+        return
+
+    def prepare(self, embedding):
+        if self.assign is None or self.assign.device != embedding.device or \
+                self.num_update >= self.rebuild_interval:
+            self.build(embedding)
+        # bucket assignments are kept between rebuilds, their centroids follow the current codewords
+        total = embedding.new_zeros(self.count.size(0), embedding.size(0)).index_add_(0, self.assign, embedding.t())
+        self.centroid = total / self.count.clamp(min=1).unsqueeze(1).type(embedding.dtype)
+        self.embedding = embedding.t()[self.order]
+        return
+
+    def row_size(self, embedding):
+        return self.count.size(0) + int(self.count.max())
+
+    def search(self, input, embedding, embedding_norm):
+        num_bucket = self.count.size(0)
+        num_probe = min(self.num_probe, num_bucket)
+        probe = nearest(input, self.centroid, num_probe).view(-1)
+        row = probe.argsort() // num_probe
+        row_count = torch.bincount(probe, minlength=num_bucket)
+        row_start = (torch.cumsum(row_count, 0) - row_count).tolist()
+        row_count, start, count = row_count.tolist(), self.start.tolist(), self.count.tolist()
+        embedding_norm = embedding_norm[self.order]
+        best_dist = input.new_full((input.size(0),), float('inf'))
+        embedding_ind = torch.zeros(input.size(0), dtype=torch.long, device=input.device)
+        for b in range(num_bucket):
+            if row_count[b] == 0 or count[b] == 0:
+                continue
+            row_b = row[row_start[b]:row_start[b] + row_count[b]]
+            code_b = slice(start[b], start[b] + count[b])
+            dist, ind = torch.addmm(embedding_norm[code_b], input[row_b], self.embedding[code_b].t(),
+                                    alpha=-2).min(1)
+            better = dist < best_dist[row_b]
+            row_b = row_b[better]
+            best_dist[row_b] = dist[better]
+            embedding_ind[row_b] = self.order[start[b] + ind[better]]
+        return embedding_ind
+
+
+def make_search(search, memory=None):
+    if search == 'exact':
+        return Search(memory)
+    elif search == 'tree':
+        return TreeSearch(memory)
+    else:
+        raise ValueError('Not valid search')
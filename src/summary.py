@@ -8,8 +8,8 @@ import torch
 import torch.nn as nn
 import torch.backends.cudnn as cudnn
 import numpy as np
-from data import fetch_dataset, make_data_loader, BatchDataset
-from utils import save, load, makedir_exist_ok, to_device, process_control, process_dataset, collate
+from data import fetch_dataset, make_data_loader, make_fields, make_derivative, BatchDataset
+from utils import save, load, load_code, makedir_exist_ok, to_device, process_control, process_dataset, collate
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 cudnn.benchmark = True
@@ -39,15 +39,15 @@ def runExperiment():
         ae_tag_list = ['0', cfg['data_name'], cfg['subset'], cfg['ae_name'], cfg['control_name']]
         cfg['ae_tag'] = '_'.join([x for x in ae_tag_list if x])
         dataset = {}
-        dataset['train'] = load('./output/code/train_{}.pt'.format(cfg['ae_tag']))
-        dataset['test'] = load('./output/code/test_{}.pt'.format(cfg['ae_tag']))
+        dataset['train'] = load_code('./output/code/train_{}.{}'.format(cfg['ae_tag'], cfg['code_format']))[0]
+        dataset['test'] = load_code('./output/code/test_{}.{}'.format(cfg['ae_tag'], cfg['code_format']))[0]
         process_dataset(dataset)
         dataset['train'] = BatchDataset(dataset['train'], cfg['bptt'], cfg['pred_length'])
         dataset['test'] = BatchDataset(dataset['test'], cfg['bptt'], cfg['pred_length'])
         model = eval('models.{}().to(cfg["device"])'.format(cfg['model_name']))
         summary = summarize(dataset['train'], model)
     else:
-        dataset = fetch_dataset(cfg['data_name'], cfg['subset'])
+        dataset = fetch_dataset(cfg['data_name'], cfg['subset'], make_fields())
         process_dataset(dataset)
         data_loader = make_data_loader(dataset)
         model = eval('models.{}().to(cfg["device"])'.format(cfg['model_name']))
@@ -139,6 +139,8 @@ def summarize(data_loader, model):
         if cfg['model_name'] not in ['transformer', 'conv_lstm']:
             input = collate(input)
         input = to_device(input, cfg['device'])
+        if cfg['model_name'] not in ['transformer', 'conv_lstm']:
+            input = make_derivative(input)
         model(input)
         break
     for h in hooks:
@@ -7,7 +7,7 @@ import models
 from config import cfg
 from data import BatchDataset, fetch_dataset
 from metrics import Metric
-from utils import save, load, to_device, process_control, process_dataset, resume, vis
+from utils import save, load, load_code, to_code, to_device, process_control, process_dataset, resume, vis
 from logger import Logger
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
@@ -46,9 +46,9 @@ def runExperiment():
     seed = int(cfg['model_tag'].split('_')[0])
     torch.manual_seed(seed)
     torch.cuda.manual_seed(seed)
-    uvw_dataset = fetch_dataset(cfg['data_name'], cfg['subset'])
+    uvw_dataset = fetch_dataset(cfg['data_name'], cfg['subset'], ['uvw', 'duvw'])
     code_dataset = {}
-    code_dataset['test'] = load('./output/code/test_{}.pt'.format(cfg['ae_tag']))
+    code_dataset['test'] = load_code('./output/code/test_{}.{}'.format(cfg['ae_tag'], cfg['code_format']))[0]
     ae = eval('models.{}().to(cfg["device"])'.format(cfg['ae_name']))
     _, ae, _, _, _ = resume(ae, cfg['ae_tag'], load_tag='best')
     model = eval('models.{}().to(cfg["device"])'.format(cfg['model_name']))
@@ -79,7 +79,7 @@ def test(uvw_dataset, code_dataset, model, ae, logger, epoch):
             code = code_dataset[i: i + (cfg['bptt'] + cfg['pred_length']) * spaceout: spaceout ]
             input_uvw = torch.stack(input_uvw, dim=0)
             input_duvw = torch.stack(input_duvw, dim=0)
-            code = code.unsqueeze(0) 
+            code = to_code(code).unsqueeze(0)
             if i==0:                
                 input = {'uvw': input_uvw[-cfg['pred_length']:], 'duvw': input_duvw[-cfg['pred_length']:],
                      'code': code[:, :cfg['bptt']], 'ncode': code[:, -cfg['pred_length']:]}
@@ -5,7 +5,7 @@ import torch
 import torch.backends.cudnn as cudnn
 import models
 from config import cfg
-from data import fetch_dataset, make_data_loader
+from data import fetch_dataset, make_data_loader, make_fields, make_derivative
 from metrics import Metric
 from utils import save, to_device, process_control, process_dataset, resume, collate, vis
 from logger import Logger
@@ -42,7 +42,7 @@ def runExperiment():
     seed = int(cfg['model_tag'].split('_')[0])
     torch.manual_seed(seed)
     torch.cuda.manual_seed(seed)
-    dataset = fetch_dataset(cfg['data_name'], cfg['subset'])
+    dataset = fetch_dataset(cfg['data_name'], cfg['subset'], make_fields())
     process_dataset(dataset['train'])
     data_loader = make_data_loader(dataset)
     model = eval('models.{}().to(cfg["device"])'.format(cfg['model_name']))
@@ -66,6 +66,7 @@ def test(data_loader, model, logger, epoch):
             input = collate(input)
             input_size = input['uvw'].size(0)
             input = to_device(input, cfg['device'])
+            input = make_derivative(input)
             output = model(input)
             output['loss'] = output['loss'].mean() if cfg['world_size'] > 1 else output['loss']
             evaluation = metric.evaluate(cfg['metric_name']['test'], input, output)
@@ -2,14 +2,14 @@ import argparse
 import datetime
 import models
 import os
-import shutil
 import time
 import torch
 import torch.backends.cudnn as cudnn
 from config import cfg
-from data import BatchDataset, fetch_dataset, make_data_loader
+from data import BatchDataset, make_shard, fetch_dataset, make_data_loader
 from metrics import Metric
-from utils import save, load, to_device, process_control, process_dataset, make_optimizer, make_scheduler, resume
+from utils import save, load, load_code, to_device, process_control, process_dataset, make_optimizer, make_scheduler, resume, \
+    init_distributed, is_main_process, make_distributed_model, CheckpointWriter
 from logger import Logger
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
@@ -34,6 +34,7 @@ cfg['model_name'] = 'transformer'
 
 def main():
     process_control()
+    init_distributed()
     seeds = list(range(cfg['init_seed'], cfg['init_seed'] + cfg['num_experiments']))
     for i in range(cfg['num_experiments']):
         ae_tag_list = [str(seeds[i]), cfg['data_name'], cfg['subset'], cfg['ae_name'], cfg['control_name']]
@@ -50,8 +51,8 @@ def runExperiment():
     torch.manual_seed(seed)
     torch.cuda.manual_seed(seed)
     dataset = {}
-    dataset['train'] = load('./output/code/train_{}.pt'.format(cfg['ae_tag']))
-    dataset['test'] = load('./output/code/test_{}.pt'.format(cfg['ae_tag']))
+    dataset['train'] = load_code('./output/code/train_{}.{}'.format(cfg['ae_tag'], cfg['code_format']))[0]
+    dataset['test'] = load_code('./output/code/test_{}.{}'.format(cfg['ae_tag'], cfg['code_format']))[0]
     process_dataset(dataset)
     ae = eval('models.{}().to(cfg["device"])'.format(cfg['ae_name']))
     _, ae, _, _, _ = resume(ae, cfg['ae_tag'], load_tag='best')
@@ -71,8 +72,8 @@ def runExperiment():
         current_time = datetime.datetime.now().strftime('%b%d_%H-%M-%S')
         logger_path = 'output/runs/train_{}_{}'.format(cfg['model_tag'], current_time)
         logger = Logger(logger_path)
-    if cfg['world_size'] > 1:
-        model = torch.nn.DataParallel(model, device_ids=list(range(cfg['world_size'])))
+    model = make_distributed_model(model)
+    checkpoint_writer = CheckpointWriter()
     for epoch in range(last_epoch, cfg['num_epochs'] + 1):
         logger.safe(True)
         train(dataset['train'], model, optimizer, logger, epoch)
@@ -87,13 +88,15 @@ def runExperiment():
             'cfg': cfg, 'epoch': epoch + 1, 'model_dict': model_state_dict,
             'optimizer_dict': optimizer.state_dict(), 'scheduler_dict': scheduler.state_dict(),
             'logger': logger}
-        save(save_result, './output/model/{}_checkpoint.pt'.format(cfg['model_tag']))
-        if cfg['pivot'] > logger.mean['test/{}'.format(cfg['pivot_metric'])]:
+        is_best = cfg['pivot'] > logger.mean['test/{}'.format(cfg['pivot_metric'])]
+        if is_main_process():
+            checkpoint_writer.write(save_result, './output/model/{}_checkpoint.pt'.format(cfg['model_tag']),
+                                    './output/model/{}_best.pt'.format(cfg['model_tag']) if is_best else None)
+        if is_best:
             cfg['pivot'] = logger.mean['test/{}'.format(cfg['pivot_metric'])]
-            shutil.copy('./output/model/{}_checkpoint.pt'.format(cfg['model_tag']),
-                        './output/model/{}_best.pt'.format(cfg['model_tag']))
         logger.reset()
     logger.safe(False)
+    checkpoint_writer.wait()
     return
 
 
@@ -101,7 +104,7 @@ def train(dataset, model, optimizer, logger, epoch):
     metric = Metric()
     model.train(True)
     start_time = time.time()
-    dataset = BatchDataset(dataset, cfg['bptt'], cfg['pred_length'])
+    dataset = make_shard(BatchDataset(dataset, cfg['bptt'], cfg['pred_length']))
     for i, input in enumerate(dataset):
         input_size = input['code'].size(0)
         optimizer.zero_grad()
@@ -145,6 +148,7 @@ def test(dataset, model, ae, logger, epoch):
             logger.append(evaluation, 'test', input_size)
         info = {'info': ['Model: {}'.format(cfg['model_tag']), 'Test Epoch: {}({:.0f}%)'.format(epoch, 100.)]}
         logger.append(info, 'test', mean=False)
+        logger.synchronize()
         logger.write('test', cfg['metric_name']['test'])
     return
 
@@ -2,15 +2,15 @@ import argparse
 import datetime
 import models
 import os
-import shutil
 import time
 import torch
 import torch.backends.cudnn as cudnn
+from torch.utils.data.distributed import DistributedSampler
 from config import cfg
-from data import fetch_dataset, make_data_loader
-from metrics import Metric
+from data import CropDataset, fetch_dataset, make_data_loader, make_fields, make_derivative
+from metrics import Metric, Accumulator
 from utils import save, to_device, process_control, process_dataset, make_optimizer, make_scheduler, resume, collate, \
-    vis
+    vis, make_autocast, make_grad_scaler, init_distributed, is_main_process, make_distributed_model, CheckpointWriter
 from logger import Logger
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
@@ -28,12 +28,14 @@ if args['control_name']:
 cfg['control_name'] = '_'.join([cfg['control'][k] for k in cfg['control']]) if 'control' in cfg else ''
 cfg['pivot_metric'] = 'MSE'
 cfg['pivot'] = float('inf')
-cfg['metric_name'] = {'train': ['Loss', 'MSE', 'D_MSE', 'Physics'], 'test': ['Loss', 'MSE', 'D_MSE', 'Physics']}
+cfg['metric_name'] = {'train': ['Loss', 'MSE', 'D_MSE', 'Physics', 'Perplexity', 'Active_Code'],
+                      'test': ['Loss', 'MSE', 'D_MSE', 'Physics', 'Perplexity', 'Active_Code']}
 cfg['model_name'] = 'vqvae'
 
 
 def main():
     process_control()
+    init_distributed()
     seeds = list(range(cfg['init_seed'], cfg['init_seed'] + cfg['num_experiments']))
     for i in range(cfg['num_experiments']):
         model_tag_list = [str(seeds[i]), cfg['data_name'], cfg['subset'], cfg['model_name'], cfg['control_name']]
@@ -47,12 +49,15 @@ def runExperiment():
     seed = int(cfg['model_tag'].split('_')[0])
     torch.manual_seed(seed)
     torch.cuda.manual_seed(seed)
-    dataset = fetch_dataset(cfg['data_name'], cfg['subset'])
+    dataset = fetch_dataset(cfg['data_name'], cfg['subset'], make_fields())
     process_dataset(dataset['train'])
+    if cfg['crop_size'] > 0:
+        dataset['train'] = CropDataset(dataset['train'], cfg['crop_size'], cfg['num_crops'])
     data_loader = make_data_loader(dataset)
     model = eval('models.{}().to(cfg["device"])'.format(cfg['model_name']))
     optimizer = make_optimizer(model)
     scheduler = make_scheduler(optimizer)
+    scaler = make_grad_scaler()
     if cfg['resume_mode'] == 1:
         last_epoch, model, optimizer, scheduler, logger = resume(model, cfg['model_tag'], optimizer, scheduler)
     elif cfg['resume_mode'] == 2:
@@ -66,12 +71,16 @@ def runExperiment():
         current_time = datetime.datetime.now().strftime('%b%d_%H-%M-%S')
         logger_path = 'output/runs/train_{}_{}'.format(cfg['model_tag'], current_time)
         logger = Logger(logger_path)
-    if cfg['world_size'] > 1:
-        model = torch.nn.DataParallel(model, device_ids=list(range(cfg['world_size'])))
+    model = make_distributed_model(model)
+    checkpoint_writer = CheckpointWriter()
     for epoch in range(last_epoch, cfg['num_epochs'] + 1):
         logger.safe(True)
-        train(data_loader['train'], model, optimizer, logger, epoch)
+        train(data_loader['train'], model, optimizer, scaler, logger, epoch)
         test(data_loader['test'], model, logger, epoch)
+        quantizers = (model.module if cfg['world_size'] > 1 else model).make_quantizers()
+        for j in range(len(quantizers)):
+            logger.histogram('train/Code_Usage{}'.format('_{}'.format(j) if len(quantizers) > 1 else ''),
+                             quantizers[j].cluster_size)
         if cfg['scheduler_name'] == 'ReduceLROnPlateau':
             scheduler.step(metrics=logger.mean['train/{}'.format(cfg['pivot_metric'])])
         else:
@@ -82,33 +91,42 @@ def runExperiment():
             'config': cfg, 'epoch': epoch + 1, 'model_dict': model_state_dict,
             'optimizer_dict': optimizer.state_dict(), 'scheduler_dict': scheduler.state_dict(),
             'logger': logger}
-        save(save_result, './output/model/{}_checkpoint.pt'.format(cfg['model_tag']))
-        if cfg['pivot'] > logger.mean['test/{}'.format(cfg['pivot_metric'])]:
+        is_best = cfg['pivot'] > logger.mean['test/{}'.format(cfg['pivot_metric'])]
+        if is_main_process():
+            checkpoint_writer.write(save_result, './output/model/{}_checkpoint.pt'.format(cfg['model_tag']),
+                                    './output/model/{}_best.pt'.format(cfg['model_tag']) if is_best else None)
+        if is_best:
             cfg['pivot'] = logger.mean['test/{}'.format(cfg['pivot_metric'])]
-            shutil.copy('./output/model/{}_checkpoint.pt'.format(cfg['model_tag']),
-                        './output/model/{}_best.pt'.format(cfg['model_tag']))
         logger.reset()
     logger.safe(False)
+    checkpoint_writer.wait()
     return
 
 
-def train(data_loader, model, optimizer, logger, epoch):
-    metric = Metric()
+def train(data_loader, model, optimizer, scaler, logger, epoch):
+    accumulator = Accumulator(cfg['metric_name']['train'])
     model.train(True)
+    if isinstance(data_loader.sampler, DistributedSampler):
+        data_loader.sampler.set_epoch(epoch)
     start_time = time.time()
     for i, input in enumerate(data_loader):
         input = collate(input)
         input_size = input['uvw'].size(0)
         input = to_device(input, cfg['device'])
+        input = make_derivative(input, periodic=cfg['crop_size'] == 0)
         optimizer.zero_grad()
-        output = model(input,Epoch=epoch)
+        with make_autocast():
+            output = model(input, Epoch=epoch, periodic=cfg['crop_size'] == 0)
         output['loss'] = output['loss'].mean() if cfg['world_size'] > 1 else output['loss']
-        output['loss'].backward()
+        scaler.scale(output['loss']).backward()
+        scaler.unscale_(optimizer)
         torch.nn.utils.clip_grad_norm_(model.parameters(), 1)
-        optimizer.step()
-        evaluation = metric.evaluate(cfg['metric_name']['train'], input, output)
-        logger.append(evaluation, 'train', n=input_size)
+        scaler.step(optimizer)
+        scaler.update()
+        accumulator.add(input, output, n=input_size)
         if i % int((len(data_loader) * cfg['log_interval']) + 1) == 0:
+            evaluation, n = accumulator.pop()
+            logger.append(evaluation, 'train', n=n)
             batch_time = (time.time() - start_time) / (i + 1)
             lr = optimizer.param_groups[0]['lr']
             epoch_finished_time = datetime.timedelta(seconds=round(batch_time * (len(data_loader) - i - 1)))
@@ -120,6 +138,8 @@ def train(data_loader, model, optimizer, logger, epoch):
                              'Experiment Finished Time: {}'.format(exp_finished_time)]}
             logger.append(info, 'train', mean=False)
             logger.write('train', cfg['metric_name']['train'])
+    evaluation, n = accumulator.pop()
+    logger.append(evaluation, 'train', n=n)
     return
 
 
@@ -131,13 +151,16 @@ def test(data_loader, model, logger, epoch):
             input = collate(input)
             input_size = input['uvw'].size(0)
             input = to_device(input, cfg['device'])
-            output = model(input)
+            input = make_derivative(input)
+            with make_autocast():
+                output = model(input)
             output['loss'] = output['loss'].mean() if cfg['world_size'] > 1 else output['loss']
             evaluation = metric.evaluate(cfg['metric_name']['test'], input, output)
             logger.append(evaluation, 'test', input_size)
         logger.append(evaluation, 'test')
         info = {'info': ['Model: {}'.format(cfg['model_tag']), 'Test Epoch: {}({:.0f}%)'.format(epoch, 100.)]}
         logger.append(info, 'test', mean=False)
+        logger.synchronize()
         logger.write('test', cfg['metric_name']['test'])
         if cfg['show']:
             vis(input, output, './output/vis')
@@ -1,13 +1,20 @@
 import collections.abc as container_abcs
+import copy
 import errno
+import json
 import numpy as np
 import os
+import shutil
+import struct
+import threading
 import torch
+import torch.distributed as dist
 import torch.optim as optim
 from itertools import repeat
 from torchvision.utils import save_image
 from matplotlib import pyplot as plt
 from config import cfg
+from models.utils import invariants
 
 
 def check_exists(path):
@@ -28,15 +35,81 @@ def makedir_exist_ok(path):
 def save(input, path, protocol=2, mode='torch'):
     dirname = os.path.dirname(path)
     makedir_exist_ok(dirname)
-    if mode == 'torch':
-        torch.save(input, path, pickle_protocol=protocol)
-    elif mode == 'numpy':
-        np.save(path, input, allow_pickle=True)
-    else:
-        raise ValueError('Not valid save mode')
+    if mode == 'numpy' and not path.endswith('.npy'):
+        path = '{}.npy'.format(path)
+    # written to a temporary file and renamed, readers never see a partial file
+    tmp_path = '{}.tmp'.format(path)
+    with open(tmp_path, 'wb') as f:
+        if mode == 'torch':
+            torch.save(input, f, pickle_protocol=protocol)
+        elif mode == 'numpy':
+            np.save(f, input, allow_pickle=True)
+        else:
+            raise ValueError('Not valid save mode')
+    os.replace(tmp_path, path)
+    return
+
+
+def link(path, link_path):
+    # a hardlink keeps the linked content when path is later replaced by save, copy where links are unsupported
+    tmp_path = '{}.tmp'.format(link_path)
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.link(path, tmp_path)
+    except OSError:
+        shutil.copy(path, tmp_path)
+    os.replace(tmp_path, link_path)
     return
 
 
+def snapshot(input):
+    if isinstance(input, torch.Tensor):
+        output = input.detach().to('cpu', copy=True)
+    elif isinstance(input, dict):
+        # shallow copy keeps the dict type and attributes such as state dict metadata
+        output = copy.copy(input)
+        for key in input:
+            output[key] = snapshot(input[key])
+    elif isinstance(input, (list, tuple)):
+        output = type(input)(snapshot(x) for x in input)
+    else:
+        output = copy.deepcopy(input)
+    return output
+
+
+class CheckpointWriter(object):
+    # saves a CPU snapshot in a background thread, the caller only blocks if the previous save is unfinished
+    def __init__(self):
+        self.thread = None
+        self.error = None
+
+    def run(self, input, path, link_path):
+        try:
+            save(input, path)
+            if link_path is not None:
+                link(path, link_path)
+        except BaseException as e:
+            self.error = e
+        return
+
+    def write(self, input, path, link_path=None):
+        input = snapshot(input)
+        self.wait()
+        self.thread = threading.Thread(target=self.run, args=(input, path, link_path))
+        self.thread.start()
+        return
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+        return
+
+
 def load(path, mode='torch'):
     if mode == 'torch':
         return torch.load(path, map_location=lambda storage, loc: storage)
@@ -47,6 +120,65 @@ def load(path, mode='torch'):
     return
 
 
+def make_code_dtype(num_embedding):
+    for dtype in [np.uint8, np.uint16, np.int32]:
+        if num_embedding - 1 <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    raise ValueError('Not valid number of embedding')
+
+
+def write_code_header(f, header):
+    header = json.dumps(header).encode('utf-8')
+    offset = -(-(8 + len(header)) // 64) * 64
+    f.write(b'VQC1')
+    f.write(struct.pack('<I', len(header)))
+    f.write(header)
+    f.write(bytes(offset - 8 - len(header)))
+    return offset
+
+
+def save_code(code, path, header):
+    makedir_exist_ok(os.path.dirname(path))
+    code = code.cpu().numpy() if isinstance(code, torch.Tensor) else code
+    code = np.ascontiguousarray(code, dtype=make_code_dtype(header['num_embedding']))
+    header = {**header, 'shape': list(code.shape), 'dtype': code.dtype.name}
+    with open(path, 'wb') as f:
+        write_code_header(f, header)
+        f.write(code.tobytes())
+    return
+
+
+def make_code(path, header, shape):
+    makedir_exist_ok(os.path.dirname(path))
+    dtype = make_code_dtype(header['num_embedding'])
+    header = {**header, 'shape': list(shape), 'dtype': dtype.name}
+    with open(path, 'wb') as f:
+        offset = write_code_header(f, header)
+        f.truncate(offset + int(np.prod(shape)) * dtype.itemsize)
+    return
+
+
+def load_code(path, mode='c'):
+    if os.path.splitext(path)[1] == '.vqd':
+        from delta import DeltaCode
+        code = DeltaCode(path)
+        return code, code.header
+    with open(path, 'rb') as f:
+        if f.read(4) != b'VQC1':
+            raise ValueError('Not valid code file')
+        header_size = struct.unpack('<I', f.read(4))[0]
+        header = json.loads(f.read(header_size).decode('utf-8'))
+    offset = -(-(8 + header_size) // 64) * 64
+    code = np.memmap(path, dtype=header['dtype'], mode=mode, offset=offset, shape=tuple(header['shape']))
+    return code, header
+
+
+def to_code(input):
+    if isinstance(input, np.ndarray):
+        input = torch.from_numpy(np.asarray(input, dtype=np.int64))
+    return input
+
+
 def save_img(img, path, nrow=10, padding=2, pad_value=0, range=None):
     makedir_exist_ok(os.path.dirname(path))
     save_image(img, path, nrow=nrow, padding=padding, pad_value=pad_value, range=range)
@@ -109,7 +241,7 @@ def process_control():
     cfg['d_mode'] = [str(x) for x in cfg['control']['d_mode'].split('-')]
     cfg['d_commit'] = [float(x) for x in cfg['control']['d_commit'].split('-')]
     cfg['vqvae'] = {'hidden_size': 128, 'depth': cfg['depth'], 'num_res_block': 2, 'res_size': 32, 'embedding_size': 64,
-                    'num_embedding': 512, 'vq_commit': 0.25}
+                    'num_embedding': cfg['num_embedding'], 'num_stage': cfg['num_stage'], 'vq_commit': 0.25}
     cfg['transformer'] = {'embedding_size': 2**(7-cfg['depth']), 'num_heads': 2, 'hidden_size': 2**(7-cfg['depth']), 'num_layers': 2,
                           'dropout': 0.2}
     cfg['conv_lstm'] = {'output_size': 2**(7-cfg['depth']), 'num_layers': 2, 'embedding_size': 2**(7-cfg['depth'])}
@@ -143,6 +275,16 @@ def process_control():
             cfg['pred_length'] = 2
         else:
             raise ValueError('Not valid model name')
+    if cfg['model_name'] in ['conv_lstm', 'transformer'] and cfg['num_stage'] > 1:
+        raise ValueError('Not valid number of stages')
+    if cfg['model_name'] in ['vqvae'] and cfg['crop_size'] > 0:
+        if cfg['crop_size'] % (2 ** cfg['depth']) != 0 or cfg['crop_size'] > cfg['data_shape'][1]:
+            raise ValueError('Not valid crop size')
+        if cfg['crop_batch_size'] > 0:
+            cfg['batch_size']['train'] = cfg['crop_batch_size']
+        else:
+            # as many crops per step as voxels in one full field
+            cfg['batch_size']['train'] = (cfg['data_shape'][1] // cfg['crop_size']) ** 3
     cfg['stats'] = make_stats()
     return
 
@@ -187,6 +329,31 @@ class Stats(object):
         return
 
 
+def init_distributed():
+    # one process per replica, launched by torchrun which sets RANK, LOCAL_RANK and WORLD_SIZE
+    if cfg['world_size'] > 1 and not dist.is_initialized():
+        if int(os.environ.get('WORLD_SIZE', 1)) != cfg['world_size']:
+            raise ValueError('Not valid world size')
+        if cfg['device'].split(':')[0] == 'cuda':
+            cfg['device'] = 'cuda:{}'.format(os.environ['LOCAL_RANK'])
+            torch.cuda.set_device(cfg['device'])
+            dist.init_process_group('nccl')
+        else:
+            dist.init_process_group('gloo')
+    return
+
+
+def is_main_process():
+    return not dist.is_initialized() or dist.get_rank() == 0
+
+
+def make_distributed_model(model):
+    if cfg['world_size'] > 1:
+        device_ids = [torch.device(cfg['device']).index] if cfg['device'].split(':')[0] == 'cuda' else None
+        model = torch.nn.parallel.DistributedDataParallel(model, device_ids=device_ids)
+    return model
+
+
 def make_optimizer(model):
     if cfg['optimizer_name'] == 'SGD':
         optimizer = optim.SGD(model.parameters(), lr=cfg['lr'], momentum=cfg['momentum'],
@@ -203,6 +370,22 @@ def make_optimizer(model):
     return optimizer
 
 
+def make_autocast(precision=None):
+    precision = cfg['precision'] if precision is None else precision
+    device_type = cfg['device'].split(':')[0]
+    if precision == 'float32':
+        return torch.autocast(device_type, enabled=False)
+    elif precision in ['bfloat16', 'float16']:
+        return torch.autocast(device_type, dtype=getattr(torch, precision))
+    else:
+        raise ValueError('Not valid precision')
+
+
+def make_grad_scaler():
+    # bfloat16 keeps the float32 exponent range, only float16 gradients need loss scaling
+    return torch.cuda.amp.GradScaler(enabled=cfg['precision'] == 'float16')
+
+
 def make_scheduler(optimizer):
     if cfg['scheduler_name'] == 'None':
         scheduler = optim.lr_scheduler.MultiStepLR(optimizer, milestones=[65535])
@@ -256,12 +439,28 @@ def collate(input):
 
 
 def batchify(dataset, batch_size):
+    if not isinstance(dataset, (torch.Tensor, np.ndarray)):
+        return BatchView(dataset, batch_size)
     num_batch = len(dataset) // batch_size
-    dataset = dataset.narrow(0, 0, num_batch * batch_size)
-    dataset = dataset.reshape(batch_size, -1, *dataset.size()[1:])
+    dataset = dataset[:num_batch * batch_size]
+    dataset = dataset.reshape(batch_size, -1, *dataset.shape[1:])
     return dataset
 
 
+class BatchView(object):
+    def __init__(self, dataset, batch_size):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.num_batch = len(dataset) // batch_size
+        self.shape = (batch_size, self.num_batch, *dataset.shape[1:])
+
+    def __getitem__(self, index):
+        b, s = index
+        start, stop, _ = s.indices(self.num_batch)
+        return np.stack([self.dataset[i * self.num_batch + start:i * self.num_batch + stop]
+                         for i in range(self.batch_size)[b]], axis=0)
+
+
 def Compute_1D_PDF(Signal, num_bins=int(1500)):
     """
     input= a signal 
@@ -339,50 +538,8 @@ def Compute_VG_Statistics(List_VG):
     for item in List_VG:
         assert item.shape == (Ng, Ng, Ng), f'"""\n input.shape is {item.shape}\n""" but not {(Ng, Ng, Ng)}'
     
-    ############# 3d
-    A_3d = np.empty((Ng ** 3, 3, 3))
-    A_3d[:, 0, 0] = List_VG[0].reshape(-1)
-    A_3d[:, 0, 1] = List_VG[1].reshape(-1)
-    A_3d[:, 0, 2] = List_VG[2].reshape(-1)
-    A_3d[:, 1, 0] = List_VG[3].reshape(-1)
-    A_3d[:, 1, 1] = List_VG[4].reshape(-1)
-    A_3d[:, 1, 2] = List_VG[5].reshape(-1)
-    A_3d[:, 2, 0] = List_VG[6].reshape(-1)
-    A_3d[:, 2, 1] = List_VG[7].reshape(-1)
-    A_3d[:, 2, 2] = List_VG[8].reshape(-1)
-
-    # Trace_A
-    Trace_A = np.trace(A_3d, axis1=1, axis2=2)
-
-    # compute R and Q
-    A2_3d = np.matmul(A_3d, A_3d)  # np.tensordot(A,A,axes=([4,3],[3,4]))
-    A2_3d_trace = np.trace(A2_3d, axis1=1, axis2=2)
-    A2_3d_trace = A2_3d_trace.reshape(Ng, Ng, Ng)
-    A3_3d = np.matmul(A2_3d, A_3d)
-    A3_3d_trace = np.trace(A3_3d, axis1=1, axis2=2)
-    A3_3d_trace = A3_3d_trace.reshape(Ng, Ng, Ng)
-
-    Q = (-1 / 2) * A2_3d_trace
-    R = (-1 / 3) * A3_3d_trace
-
-    # compute S_ijS_ij, R_ijR_ij
-    S_3d = (1 / 2) * (A_3d + A_3d.transpose(0, 2, 1))
-    Rot_3d = (1 / 2) * (A_3d - A_3d.transpose(0, 2, 1))
-
-    SijSij_3d = np.sum(S_3d * S_3d, axis=(1, 2)).reshape(Ng, Ng, Ng)
-    RijRij_3d = np.sum(Rot_3d * Rot_3d, axis=(1, 2)).reshape(Ng, Ng, Ng)
-
-    # compute SijSkjSji, VortexStret    
-    Omega_2d = np.empty((Ng ** 3, 3, 1))
-    Omega_2d[:, 0, 0] = 2 * Rot_3d[:, 2, 1]
-    Omega_2d[:, 1, 0] = 2 * Rot_3d[:, 0, 2]
-    Omega_2d[:, 2, 0] = 2 * Rot_3d[:, 1, 0]
-    VS_3d = np.matmul(S_3d, Omega_2d)
-
-    VortexStret = np.matmul(Omega_2d.transpose(0, 2, 1), VS_3d).reshape(Ng, Ng, Ng)
-    SijSkjSji = np.sum(np.matmul(S_3d, S_3d) * S_3d, axis=(1, 2)).reshape(Ng, Ng, Ng)
-    Dict_VG_Stat_Outputs = {'Trace_A': Trace_A, 'Q': Q, 'R': R, 'S_ijS_ij': SijSij_3d, 'R_ijR_ij': RijRij_3d, \
-                            'VS': VortexStret, 'SijSkjSji': SijSkjSji}
+    A = [[np.asarray(List_VG[3 * i + j], dtype=np.float64) for j in range(3)] for i in range(3)]
+    Dict_VG_Stat_Outputs = invariants(A)
     return Dict_VG_Stat_Outputs
 
 